@@ -0,0 +1,133 @@
+"""
+图片批量导入导出相关
+"""
+import asyncio
+import contextlib
+import os
+import tarfile
+import tempfile
+import zipfile
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple
+
+# 导入时识别为图片的扩展名
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp"}
+
+# tar 包按扩展名选择压缩方式
+TAR_MODES = {".tar": "w", ".tar.gz": "w:gz", ".tgz": "w:gz", ".tar.bz2": "w:bz2", ".tar.xz": "w:xz"}
+
+
+def _is_image(name: str) -> bool:
+    base = os.path.basename(name)
+    if not base or base.startswith(".") or "__MACOSX" in name:
+        return False
+    return os.path.splitext(base)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_images(source: str, max_bytes: Optional[int] = None) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """逐个读取 zip/tar 包或目录中的图片，返回 (路径, 内容)；超过 max_bytes 的图片内容为 None
+
+    zip 包和目录按条目读取，tar 包（含 .tar.gz 等）以流模式顺序读取，内存中同时只有一张图片。
+    """
+    if not os.path.exists(source):
+        raise Exception(f"路径不存在：{source}")
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                if not _is_image(path):
+                    continue
+                name = os.path.relpath(path, source)
+                if max_bytes is not None and os.path.getsize(path) > max_bytes:
+                    yield name, None
+                    continue
+                with open(path, "rb") as f:
+                    yield name, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not _is_image(info.filename):
+                    continue
+                if max_bytes is not None and info.file_size > max_bytes:
+                    yield info.filename, None
+                    continue
+                yield info.filename, zf.read(info)
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, "r|*") as tf:
+            for member in tf:
+                if not member.isfile() or not _is_image(member.name):
+                    continue
+                if max_bytes is not None and member.size > max_bytes:
+                    yield member.name, None
+                    continue
+                yield member.name, tf.extractfile(member).read()
+    else:
+        raise Exception("不支持的格式，请使用 zip、tar（含 .tar.gz 等）压缩包或图片目录")
+
+
+async def iter_images_async(source: str,
+                            max_bytes: Optional[int] = None) -> AsyncIterator[Tuple[str, Optional[bytes]]]:
+    """在工作线程中读取 iter_images，不阻塞事件循环"""
+    it = iter_images(source, max_bytes)
+    try:
+        while True:
+            item = await asyncio.to_thread(next, it, None)
+            if item is None:
+                return
+            yield item
+    finally:
+        # 读取中途被取消时生成器仍在工作线程中执行，此时无法关闭
+        with contextlib.suppress(ValueError):
+            it.close()
+
+
+def archive_mode(dest: str) -> Optional[str]:
+    """按目标文件名返回 "zip" 或 tarfile 的写入模式，不支持时返回 None"""
+    lower = dest.lower()
+    if lower.endswith(".zip"):
+        return "zip"
+    for ext in sorted(TAR_MODES, key=len, reverse=True):
+        if lower.endswith(ext):
+            return TAR_MODES[ext]
+    return None
+
+
+def write_archive(dest: str, files: Iterable[Tuple[str, str]]) -> Tuple[int, int]:
+    """把 (包内名称, 文件路径) 逐个写入压缩包，返回 (写入的文件数, 字节数)
+
+    文件按块从磁盘复制到压缩包，不整体读入内存；图片本身已经压缩，zip 包只存储不再压缩。
+    先写入临时文件，完成后再替换为 dest；写入期间被删除的文件会跳过。
+    """
+    mode = archive_mode(dest)
+    if mode is None:
+        raise Exception("不支持的导出格式，请使用 .zip、.tar、.tar.gz、.tgz、.tar.bz2 或 .tar.xz")
+    directory = os.path.dirname(os.path.abspath(dest))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    os.close(fd)
+    count = size = 0
+    try:
+        if mode == "zip":
+            with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for arcname, path in files:
+                    try:
+                        zf.write(path, arcname)
+                    except FileNotFoundError:
+                        continue
+                    count += 1
+                    size += zf.getinfo(arcname).file_size
+        else:
+            with tarfile.open(tmp_path, mode) as tf:
+                for arcname, path in files:
+                    try:
+                        tf.add(path, arcname)
+                    except FileNotFoundError:
+                        continue
+                    count += 1
+                    size += os.path.getsize(path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count, size
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""
+插件模块导入耗时测试（基于 python -X importtime）
+
+用法：python bench_import.py [-n 次数] [模块 ...]
+
+每次启动新的解释器，以包的形式导入插件模块（默认为除 main 外的全部模块），
+输出每个模块累计导入耗时的中位数，并列出导入过程中被加载的重型依赖。
+在改动前后的版本上各运行一次即可比较插件冷启动的导入开销。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# 插件用到的重型依赖，加载插件时不应出现在导入列表中
+HEAVY = ("PIL", "aiohttp", "lxml", "numpy", "openpyxl", "pandas")
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = os.path.basename(PLUGIN_DIR)
+DEFAULT_MODULES = sorted(
+    os.path.splitext(f)[0] for f in os.listdir(PLUGIN_DIR)
+    if f.endswith(".py") and f not in ("main.py", "bench_import.py", "__init__.py"))
+
+
+def import_once(modules):
+    """在新的解释器中导入 modules，返回 ({模块: 累计微秒}, 总微秒, 被加载的重型依赖)"""
+    code = "; ".join(f"import {PACKAGE}.{m}" for m in modules)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(PLUGIN_DIR), env.get("PYTHONPATH")]))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr.strip().splitlines()[-1])
+    cumulative = {}
+    total = 0
+    heavy = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cum, name = line[len("import time:"):].split("|")
+        if not cum.strip().isdigit():
+            continue
+        # 名称前的缩进表示嵌套深度，被其他模块导入的模块只出现在第一次导入的位置
+        top_level = name[1:2] != " "
+        name = name.strip()
+        if name == PACKAGE or name.startswith(PACKAGE + "."):
+            cumulative[name[len(PACKAGE) + 1:]] = int(cum)
+            if top_level:
+                total += int(cum)
+        elif name.split(".")[0] in HEAVY:
+            heavy.add(name.split(".")[0])
+    return cumulative, total, heavy
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("-n", "--repeat", type=int, default=5, help="重复次数，取中位数")
+    ap.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="要导入的模块")
+    args = ap.parse_args()
+
+    runs = []
+    totals = []
+    heavy = set()
+    for _ in range(args.repeat):
+        cumulative, total, loaded = import_once(args.modules)
+        runs.append(cumulative)
+        totals.append(total)
+        heavy |= loaded
+
+    print(f"{'模块':<16}{'累计导入耗时(ms)':>16}")
+    for module in args.modules:
+        times = [run[module] for run in runs if module in run]
+        if times:
+            print(f"{module:<16}{statistics.median(times) / 1000:>16.1f}")
+    print(f"{'合计':<16}{statistics.median(totals) / 1000:>16.1f}")
+    print(f"加载的重型依赖：{', '.join(sorted(heavy)) or '无'}")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""
+按内容寻址、引用计数的图片存储
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+from astrbot.logger import logger
+
+
+class BlobStore:
+    """所有图库共用的图片存储
+
+    图片以 “sha256(存储内容) + 扩展名” 命名，存放在 root/<前两位>/ 下，同一内容只保存一份；
+    图库清单只记录 blob 名称，每条引用对应一次引用计数。引用计数归零的 blob 由后台垃圾回收删除。
+    另外记录 (原图哈希, 压缩参数) -> blob 的映射，同一张图片以相同参数存入其他图库时无需再次压缩。
+    多个进程共用存储时，写入和删除文件都在数据库写事务中进行；只有 gc_enabled 为真的进程执行垃圾回收。
+    """
+
+    def __init__(self, root: str, db_file: Optional[str] = None):
+        self.root = root
+        self.trash_dir = os.path.join(root, "trash")
+        self.db_file = db_file or os.path.join(root, "blobs.db")
+        self.gc_enabled = True
+        os.makedirs(root, exist_ok=True)
+        # 写入与回收互斥，避免回收删除刚被重新引用的文件
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                blob TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                touched_at REAL NOT NULL DEFAULT 0)""")
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(blobs)")}
+            if "touched_at" not in columns:
+                self._db.execute("ALTER TABLE blobs ADD COLUMN touched_at REAL NOT NULL DEFAULT 0")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS blob_sources (
+                source TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                blob TEXT NOT NULL,
+                dhash TEXT NOT NULL,
+                PRIMARY KEY (source, variant))""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_blobs_refcount ON blobs (refcount)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_blob_sources_blob ON blob_sources (blob)")
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="kcbxt-blob-gc")
+        self._gc_future: Optional[Future] = None
+
+    def path(self, blob: str) -> str:
+        """blob 文件的路径"""
+        return os.path.join(self.root, blob[:2], blob)
+
+    def _store(self, blob: str, size: int, write) -> str:
+        """登记 blob 并增加一次引用；文件不存在时调用 write(目标路径) 写入文件
+
+        先增加引用再检查文件，写事务期间其他进程的垃圾回收无法删除这个 blob。
+        """
+        with self._lock, self._db:
+            now = time.time()
+            self._db.execute("INSERT INTO blobs (blob, size, refcount, created_at, touched_at) VALUES (?, ?, 1, ?, ?) "
+                             "ON CONFLICT (blob) DO UPDATE SET refcount = refcount + 1, touched_at = excluded.touched_at",
+                             (blob, size, now, now))
+            path = self.path(blob)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write(path)
+        return blob
+
+    def put(self, data: bytes, ext: str) -> str:
+        """保存图片内容并增加一次引用，返回 blob 名称"""
+        blob = hashlib.sha256(data).hexdigest() + ext
+
+        def write(path: str):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        return self._store(blob, len(data), write)
+
+    def put_file(self, filepath: str, ext: str) -> str:
+        """把已有文件复制到存储并增加一次引用，原文件保持不变，返回 blob 名称"""
+        with open(filepath, "rb") as f:
+            return self.put(f.read(), ext)
+
+    def remember_source(self, source: str, variant: str, blob: str, dhash: int):
+        """记录原图以某种压缩参数存储后对应的 blob"""
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO blob_sources VALUES (?, ?, ?, ?)",
+                             (source, variant, blob, f"{dhash:016x}"))
+
+    def acquire_source(self, source: str, variant: str) -> Optional[Tuple[str, int, int]]:
+        """按原图哈希和压缩参数查找已存储的 blob，找到时增加一次引用并返回 (blob, 大小, 感知哈希)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT s.blob, b.size, s.dhash FROM blob_sources s JOIN blobs b ON b.blob = s.blob "
+                "WHERE s.source = ? AND s.variant = ?", (source, variant)).fetchone()
+            if row is None or not os.path.exists(self.path(row[0])):
+                return None
+            with self._db:
+                cur = self._db.execute("UPDATE blobs SET refcount = refcount + 1, touched_at = ? "
+                                       "WHERE blob = ?", (time.time(), row[0]))
+                # 其他进程的垃圾回收可能刚删除了这个 blob
+                if not cur.rowcount or not os.path.exists(self.path(row[0])):
+                    self._db.rollback()
+                    return None
+        return row[0], row[1], int(row[2], 16)
+
+    def release(self, blobs: Iterable[str]):
+        """减少引用计数，归零的 blob 等待垃圾回收"""
+        counts = Counter(blobs)
+        if not counts:
+            return
+        with self._lock, self._db:
+            self._db.executemany("UPDATE blobs SET refcount = MAX(refcount - ?, 0) WHERE blob = ?",
+                                 [(n, blob) for blob, n in counts.items()])
+
+    def rebuild_refcounts(self, references: Counter, grace: float = 300):
+        """按图库清单中的实际引用重新计算引用计数，修复异常退出造成的偏差
+
+        最近 grace 秒内写入或引用过的 blob 可能还没有登记到清单中，保持原有计数。
+        """
+        with self._lock, self._db:
+            cutoff = time.time() - grace
+            self._db.execute("UPDATE blobs SET refcount = 0 WHERE touched_at < ?", (cutoff,))
+            self._db.executemany("UPDATE blobs SET refcount = ? WHERE blob = ? AND touched_at < ?",
+                                 [(n, blob, cutoff) for blob, n in references.items()])
+
+    def discard_dir(self, path: str):
+        """把目录移入回收区，由垃圾回收删除"""
+        if not os.path.isdir(path):
+            return
+        os.makedirs(self.trash_dir, exist_ok=True)
+        os.replace(path, os.path.join(self.trash_dir, f"{os.path.basename(path)}-{time.time_ns()}"))
+
+    def collect(self) -> Tuple[int, int]:
+        """删除引用计数为零的 blob 和回收区中的目录，返回 (删除的文件数, 释放的字节数)"""
+        removed = freed = 0
+        with self._lock:
+            candidates = self._db.execute("SELECT blob, size FROM blobs WHERE refcount <= 0").fetchall()
+        for blob, size in candidates:
+            with self._lock:
+                with self._db:
+                    cur = self._db.execute("DELETE FROM blobs WHERE blob = ? AND refcount <= 0", (blob,))
+                    if not cur.rowcount:
+                        continue
+                    self._db.execute("DELETE FROM blob_sources WHERE blob = ?", (blob,))
+                    # 在写事务中删除文件，其他进程不会在删除前后重新引用它
+                    path = self.path(blob)
+                    if os.path.exists(path):
+                        os.remove(path)
+            removed += 1
+            freed += size
+        if os.path.isdir(self.trash_dir):
+            for name in os.listdir(self.trash_dir):
+                shutil.rmtree(os.path.join(self.trash_dir, name), ignore_errors=True)
+        if removed:
+            logger.info(f"[KCBXT] 图片存储回收了 {removed} 个文件，释放 {freed // 1024}KB")
+        return removed, freed
+
+    def collect_later(self) -> Optional[Future]:
+        """在后台线程中执行垃圾回收，已有回收任务排队等待时不重复提交；gc_enabled 为假时不回收"""
+        if not self.gc_enabled:
+            return None
+        if self._gc_future is None or self._gc_future.running() or self._gc_future.done():
+            self._gc_future = self._executor.submit(self.collect)
+        return self._gc_future
+
+    def stats(self) -> Dict:
+        """存储的 blob 数、总字节数和全部引用数"""
+        with self._lock:
+            count, size, refs = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM blobs").fetchone()
+        return {"blobs": count, "bytes": size, "references": refs}
+
+    def close(self):
+        """等待后台回收结束并关闭数据库"""
+        self._executor.shutdown(wait=True)
+        self._db.close()
\ No newline at end of file
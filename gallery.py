@@ -1,13 +1,427 @@
 import os
 import json
 import random
-from typing import Optional, List, Dict
-from PIL import Image
-import io
+import asyncio
+import time
+import sqlite3
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Tuple, Callable, Awaitable, AsyncIterator
+from collections import Counter
+from astrbot.logger import logger
+from .archive import IMAGE_EXTENSIONS, iter_images_async, write_archive
+from .blobstore import BlobStore
+from .imaging import (ImagePipeline, compress_image, content_hash, hash_image, hash_image_file, image_extension,
+                      perceptual_hash, read_file, CODECS)
+from .matcher import KeywordMatcher
+
+# 批量导入时每处理这么多张图片报告一次进度
+IMPORT_PROGRESS_STEP = 1000
+
+def is_valid_gallery_name(name: str) -> bool:
+    """图库名用作图库根目录下的目录名，不能为空、包含路径分隔符或“..”、以“.”开头"""
+    if not name or name.startswith(".") or ".." in name or "\0" in name:
+        return False
+    return not any(sep in name for sep in ("/", "\\", os.sep, os.altsep) if sep)
+
+def hamming_distance(a: int, b: int) -> int:
+    """两个哈希之间的汉明距离"""
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """按汉明距离组织的BK树，用于查找相似哈希"""
+
+    def __init__(self):
+        # 节点结构：[哈希, {距离: 子节点}, 文件名集合]
+        self.root = None
+
+    def add(self, value: int, key: str):
+        """插入哈希及对应的文件名"""
+        if self.root is None:
+            self.root = [value, {}, {key}]
+            return
+        node = self.root
+        while True:
+            dist = hamming_distance(value, node[0])
+            if dist == 0:
+                node[2].add(key)
+                return
+            child = node[1].get(dist)
+            if child is None:
+                node[1][dist] = [value, {}, {key}]
+                return
+            node = child
+
+    def remove(self, value: int, key: str):
+        """移除文件名，节点保留以维持树结构"""
+        node = self.root
+        while node is not None:
+            dist = hamming_distance(value, node[0])
+            if dist == 0:
+                node[2].discard(key)
+                return
+            node = node[1].get(dist)
+
+    def find(self, value: int, max_distance: int) -> Optional[str]:
+        """查找距离不超过 max_distance 的任意一个文件名"""
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            dist = hamming_distance(value, node[0])
+            if dist <= max_distance and node[2]:
+                return next(iter(node[2]))
+            for d, child in node[1].items():
+                if dist - max_distance <= d <= dist + max_distance:
+                    stack.append(child)
+        return None
+
+def cluster_duplicates(hashes: List[Tuple[str, str, int]], max_distance: int) -> List[List[str]]:
+    """将 (文件名, 内容哈希, 感知哈希) 列表聚类为重复组，每组第一个为保留的图片
+
+    max_distance 为 0 时只按内容哈希分组，感知哈希相同的不同图片不算重复。
+    """
+    groups: Dict[str, List[str]] = {}
+    by_hash: Dict[str, str] = {}
+    tree = BKTree()
+    for filename, sha256, phash in hashes:
+        kept = by_hash.get(sha256)
+        if kept is None and max_distance > 0:
+            kept = tree.find(phash, max_distance)
+        if kept:
+            groups[kept].append(filename)
+            continue
+        groups[filename] = [filename]
+        by_hash[sha256] = filename
+        tree.add(phash, filename)
+    return [group for group in groups.values() if len(group) > 1]
+
+def init_manifest_tables(db: sqlite3.Connection):
+    """创建图库清单表：gallery_images 每张图片一行，gallery_versions 记录各图库清单的修改次数，
+    gallery_inbox 记录已处理过的手动放入图库目录的文件
+
+    触发器把每次写入时的清单版本记入条目的 seq，移除的条目编号记入 gallery_removals，
+    重新加载时只需读取版本号大于已读版本的行。gallery_versions.pruned 之前的移除记录已被清理。
+    """
+    with db:
+        db.execute("""CREATE TABLE IF NOT EXISTS gallery_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            gallery TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            blob TEXT,
+            size INTEGER NOT NULL DEFAULT 0,
+            sha256 TEXT NOT NULL,
+            dhash TEXT NOT NULL,
+            added_at INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (gallery, filename))""")
+        columns = {row[1] for row in db.execute("PRAGMA table_info(gallery_images)")}
+        if "seq" not in columns:
+            db.execute("ALTER TABLE gallery_images ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_gallery_images_blob ON gallery_images (blob)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_gallery_images_seq ON gallery_images (gallery, seq)")
+        db.execute("CREATE TABLE IF NOT EXISTS gallery_versions (gallery TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+                   "pruned INTEGER NOT NULL DEFAULT 0)")
+        columns = {row[1] for row in db.execute("PRAGMA table_info(gallery_versions)")}
+        if "pruned" not in columns:
+            db.execute("ALTER TABLE gallery_versions ADD COLUMN pruned INTEGER NOT NULL DEFAULT 0")
+        db.execute("""CREATE TABLE IF NOT EXISTS gallery_removals (
+            gallery TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            seq INTEGER NOT NULL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_gallery_removals_seq ON gallery_removals (gallery, seq)")
+        version = "(SELECT COALESCE(MAX(version), 0) FROM gallery_versions WHERE gallery = {}.gallery)"
+        db.execute(f"""CREATE TRIGGER IF NOT EXISTS gallery_images_inserted AFTER INSERT ON gallery_images BEGIN
+            UPDATE gallery_images SET seq = {version.format("NEW")} WHERE id = NEW.id; END""")
+        db.execute(f"""CREATE TRIGGER IF NOT EXISTS gallery_images_updated AFTER UPDATE OF filename, blob, size
+            ON gallery_images BEGIN
+            UPDATE gallery_images SET seq = {version.format("NEW")} WHERE id = NEW.id; END""")
+        db.execute(f"""CREATE TRIGGER IF NOT EXISTS gallery_images_deleted AFTER DELETE ON gallery_images BEGIN
+            INSERT INTO gallery_removals VALUES (OLD.gallery, OLD.id, {version.format("OLD")}); END""")
+        db.execute("""CREATE TABLE IF NOT EXISTS gallery_inbox (
+            gallery TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (gallery, filename))""")
+
+class GalleryManifest:
+    """图库清单：按添加顺序排列的图片条目，附带精确哈希字典和感知哈希BK树
+
+    条目字段：id、filename、blob、size、sha256、dhash、added_at。filename 是图库内的图片名，
+    blob 是图片在共享存储中的名称，sha256 是原图的内容哈希。条目保存在图库数据库的 gallery_images 表中，
+    每次增删只写对应的行，多个进程同时修改同一个图库时不会互相覆盖；计数、按序号查找和随机抽取只读内存。
+    version 是本进程已经读到的清单版本，与 gallery_versions 表中不同时说明清单被其他进程修改过，
+    重新加载时只读取此后写入的条目和移除记录。
+    """
+
+    # 每隔这么多个版本清理一次移除记录，只保留最近 REMOVALS_KEPT 个版本的
+    PRUNE_INTERVAL = 100
+    REMOVALS_KEPT = 1000
+
+    def __init__(self, db: sqlite3.Connection, gallery: str, legacy_file: Optional[str] = None):
+        self.db = db
+        self.gallery = gallery
+        self.entries: List[Dict] = []
+        # 生成文件名用的序号
+        self.next_id = 1
+        # 本进程写入清单的次数，用于判断后台读取期间清单是否被本进程修改
+        self._writes = 0
+        self._by_name: Dict[str, Dict] = {}
+        self._by_hash: Dict[str, str] = {}
+        self._tree = BKTree()
+        self.version = 0
+        init_manifest_tables(db)
+        if legacy_file and os.path.exists(legacy_file):
+            self._migrate(legacy_file)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _migrate(self, legacy_file: str):
+        """把旧版 JSON 清单导入数据库，原文件改名为 .bak"""
+        with open(legacy_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries = data.get("entries", [])
+        if isinstance(entries, dict):
+            # 旧版索引格式 {文件名: {sha256, dhash}}，按文件名排序保持原有序号
+            entries = [{"filename": filename, **e} for filename, e in sorted(entries.items())]
+        entries.sort(key=lambda e: e.get("id", 0))
+        if self.db.execute("SELECT 1 FROM gallery_images WHERE gallery = ? LIMIT 1", (self.gallery,)).fetchone() is None:
+            # 多个进程同时启动时可能都在导入，已导入的条目直接跳过
+            self._commit(lambda: self.db.executemany(
+                "INSERT OR IGNORE INTO gallery_images (gallery, filename, blob, size, sha256, dhash, added_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.gallery, e["filename"], e.get("blob"), e.get("size", 0), e["sha256"], e["dhash"],
+                  e.get("added_at", 0)) for e in entries]))
+        with contextlib.suppress(FileNotFoundError):
+            os.replace(legacy_file, legacy_file + ".bak")
+
+    def _read_version(self) -> int:
+        row = self.db.execute("SELECT version FROM gallery_versions WHERE gallery = ?", (self.gallery,)).fetchone()
+        return row[0] if row else 0
+
+    def _read(self, db: sqlite3.Connection, since: int = -1) -> List[Dict]:
+        rows = db.execute("SELECT id, filename, blob, size, sha256, dhash, added_at FROM gallery_images "
+                          "WHERE gallery = ? AND seq > ? ORDER BY id", (self.gallery, since))
+        return [{"id": r[0], "filename": r[1], "blob": r[2], "size": r[3], "sha256": r[4], "dhash": int(r[5], 16),
+                 "added_at": r[6]} for r in rows]
+
+    def _load(self):
+        # 先读版本再读条目，两次读取之间有其他进程写入时版本偏旧，下次检查时再重新加载一次
+        self.version = self._read_version()
+        for entry in self._read(self.db):
+            self._insert(entry)
+        self.next_id = len(self.entries) + 1
+
+    def _commit(self, write: Callable):
+        """在一个事务中执行 write() 并增加清单版本，返回 write() 的结果
+
+        事务开始前清单已被其他进程修改时 version 保持不变，下次检查时读取这期间的修改。
+        """
+        with self.db:
+            self.db.execute("INSERT INTO gallery_versions (gallery, version) VALUES (?, 1) "
+                            "ON CONFLICT (gallery) DO UPDATE SET version = version + 1", (self.gallery,))
+            version = self._read_version()
+            result = write()
+            self._writes += 1
+            if version % self.PRUNE_INTERVAL == 0 and version > self.REMOVALS_KEPT:
+                # 落后超过 REMOVALS_KEPT 个版本的进程改为重新读取全部条目
+                pruned = version - self.REMOVALS_KEPT
+                self.db.execute("DELETE FROM gallery_removals WHERE gallery = ? AND seq <= ?", (self.gallery, pruned))
+                self.db.execute("UPDATE gallery_versions SET pruned = MAX(pruned, ?) WHERE gallery = ?",
+                                (pruned, self.gallery))
+        if version == self.version + 1:
+            self.version = version
+        return result
+
+    def read_changes(self, db: sqlite3.Connection, since: int) -> Tuple[int, bool, List[Dict], List[int]]:
+        """读取清单版本 since 之后的修改，返回 (当前版本, 是否读取了全部条目, 新增或修改的条目, 移除的条目编号)
+
+        只读取 seq 大于 since 的条目和移除记录，since 之后的移除记录已被清理时读取全部条目。
+        不修改内存中的清单，可以用单独的连接在工作线程中执行，结果交给 apply_changes。
+        """
+        # 在一个读事务中读取，版本、条目和移除记录来自同一个快照
+        db.execute("BEGIN")
+        try:
+            row = db.execute("SELECT version, pruned FROM gallery_versions WHERE gallery = ?",
+                             (self.gallery,)).fetchone()
+            version, pruned = row or (0, 0)
+            full = since < pruned
+            entries = self._read(db, -1 if full else since)
+            removed = [] if full else [row[0] for row in db.execute(
+                "SELECT id FROM gallery_removals WHERE gallery = ? AND seq > ?", (self.gallery, since))]
+        finally:
+            db.rollback()
+        return version, full, entries, removed
+
+    def apply_changes(self, version: int, full: bool, entries: List[Dict], removed: List[int]) -> Tuple[int, int]:
+        """把 read_changes 读到的修改应用到内存，返回 (新增数, 移除数)"""
+        current = {entry["id"]: entry for entry in entries}
+        if full:
+            gone = [entry for entry in self.entries if entry["id"] not in current]
+        else:
+            removed = set(removed)
+            gone = [entry for entry in self.entries if entry["id"] in removed]
+        for entry in gone:
+            self._discard(entry)
+        known = {entry["id"]: entry for entry in self.entries}
+        added = []
+        for entry_id, entry in current.items():
+            if entry_id in known:
+                # 旧版条目复制到存储后会补上 blob
+                known[entry_id].update(blob=entry["blob"], size=entry["size"])
+            else:
+                added.append(entry)
+        for entry in added:
+            self._insert(entry)
+        if added:
+            self.entries.sort(key=lambda e: e["id"])
+        self.version = max(self.version, version)
+        return len(added), len(gone)
+
+    def reload(self) -> Tuple[int, int]:
+        """重新读取被其他进程修改的清单，只把增删的条目应用到内存，返回 (新增数, 移除数)"""
+        return self.apply_changes(*self.read_changes(self.db, self.version))
+
+    async def reload_async(self, db: sqlite3.Connection) -> Optional[Tuple[int, int]]:
+        """在工作线程中用连接 db 读取被其他进程修改的部分，事件循环上只应用增删，返回 (新增数, 移除数)
+
+        读取期间本进程又修改了清单时不应用，返回 None，下次检查时重新读取。
+        """
+        writes = self._writes
+        changes = await asyncio.to_thread(self.read_changes, db, self.version)
+        if self._writes != writes:
+            return None
+        return self.apply_changes(*changes)
+
+    def _insert(self, entry: Dict):
+        self.entries.append(entry)
+        self._by_name[entry["filename"]] = entry
+        self._by_hash.setdefault(entry["sha256"], entry["filename"])
+        self._tree.add(entry["dhash"], entry["filename"])
+
+    def _discard(self, entry: Dict):
+        """只从内存中移除条目"""
+        filename = entry["filename"]
+        del self._by_name[filename]
+        self.entries.remove(entry)
+        self._tree.remove(entry["dhash"], filename)
+        if self._by_hash.get(entry["sha256"]) == filename:
+            del self._by_hash[entry["sha256"]]
+            for other in self.entries:
+                if other["sha256"] == entry["sha256"]:
+                    self._by_hash[entry["sha256"]] = other["filename"]
+                    break
+
+    def new_filename(self, label: str, ext: str) -> str:
+        """生成不与现有图片冲突的文件名"""
+        while f"{label}_{self.next_id}{ext}" in self._by_name:
+            self.next_id += 1
+        return f"{label}_{self.next_id}{ext}"
+
+    def add(self, filename: str, sha256: str, phash: int, size: int, blob: str) -> Dict:
+        """登记一张图片；文件名已被其他进程占用时重新加载清单并改用新的文件名"""
+        self.remove(filename)
+        entry = {
+            "filename": filename,
+            "blob": blob,
+            "size": size,
+            "sha256": sha256,
+            "dhash": phash,
+            "added_at": int(time.time()),
+        }
+        while True:
+            try:
+                entry["id"] = self._commit(lambda: self.db.execute(
+                    "INSERT INTO gallery_images (gallery, filename, blob, size, sha256, dhash, added_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.gallery, entry["filename"], blob, size, sha256, f"{phash:016x}", entry["added_at"])).lastrowid)
+                break
+            except sqlite3.IntegrityError:
+                self.reload()
+                stem, ext = os.path.splitext(filename)
+                entry["filename"] = self.new_filename(stem, ext)
+        self.next_id += 1
+        self._insert(entry)
+        return entry
+
+    def set_blob(self, entry: Dict, blob: str, size: int):
+        """旧版条目复制到存储后记录其 blob"""
+        self._commit(lambda: self.db.execute("UPDATE gallery_images SET blob = ?, size = ? WHERE id = ?",
+                                             (blob, size, entry["id"])))
+        entry.update(blob=blob, size=size)
+
+    def get(self, filename: str) -> Optional[Dict]:
+        """按文件名获取条目"""
+        return self._by_name.get(filename)
+
+    def remove(self, filename: str) -> Optional[Dict]:
+        """移除一张图片"""
+        removed = self.remove_all([filename])
+        return removed[0] if removed else None
+
+    def remove_all(self, filenames: List[str]) -> List[Dict]:
+        """在一个事务中移除多张图片，返回被移除的条目"""
+        entries = [self._by_name[filename] for filename in dict.fromkeys(filenames) if filename in self._by_name]
+        if not entries:
+            return []
+        self._commit(lambda: self.db.executemany("DELETE FROM gallery_images WHERE id = ?",
+                                                 [(entry["id"],) for entry in entries]))
+        for entry in entries:
+            self._discard(entry)
+        return entries
+
+    def clear(self) -> List[Dict]:
+        """清空清单，返回被移除的条目"""
+        return self.remove_all([entry["filename"] for entry in self.entries])
+
+    def drop(self) -> List[str]:
+        """删除整个清单，返回数据库中各条目引用的 blob（含其他进程刚添加、本进程尚未加载的条目）"""
+        with self.db:
+            # 先增加版本开始写事务，读取和删除条目之间其他进程无法插入；
+            # 同时清理全部移除记录，尚未读到删除的进程重新读取全部条目
+            self.db.execute("INSERT INTO gallery_versions (gallery, version, pruned) VALUES (?, 1, 1) "
+                            "ON CONFLICT (gallery) DO UPDATE SET version = version + 1, pruned = version + 1",
+                            (self.gallery,))
+            blobs = [row[0] for row in self.db.execute(
+                "SELECT blob FROM gallery_images WHERE gallery = ? AND blob IS NOT NULL", (self.gallery,))]
+            self.db.execute("DELETE FROM gallery_images WHERE gallery = ?", (self.gallery,))
+            self.db.execute("DELETE FROM gallery_removals WHERE gallery = ?", (self.gallery,))
+            self.db.execute("DELETE FROM gallery_inbox WHERE gallery = ?", (self.gallery,))
+            self._writes += 1
+        for entry in list(self.entries):
+            self._discard(entry)
+        return blobs
+
+    def inbox_seen(self) -> Dict[str, Tuple[int, int]]:
+        """已处理过的手动放入的文件 {文件名: (修改时间, 大小)}，文件不变时不再处理"""
+        return {row[0]: (row[1], row[2]) for row in self.db.execute(
+            "SELECT filename, mtime_ns, size FROM gallery_inbox WHERE gallery = ?", (self.gallery,))}
+
+    def mark_inbox(self, files: Dict[str, Tuple[int, int]]):
+        """记录已处理（登记或无法识别）的手动放入的文件"""
+        if not files:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO gallery_inbox VALUES (?, ?, ?, ?)",
+                                [(self.gallery, filename, mtime, size) for filename, (mtime, size) in files.items()])
+
+    def find_exact(self, sha256: str) -> Optional[str]:
+        """按内容哈希查找，O(1)"""
+        return self._by_hash.get(sha256)
+
+    def find_similar(self, phash: int, max_distance: int) -> Optional[str]:
+        """按感知哈希查找汉明距离不超过 max_distance 的图片"""
+        return self._tree.find(phash, max_distance)
 
 class Gallery:
     def __init__(self, name: str, path: str, creator_id: str, creator_name: str, 
-                 capacity: int = 200, compress: bool = True, duplicate: bool = True, fuzzy: bool = False):
+                 capacity: int = 200, compress: bool = True, duplicate: bool = True, fuzzy: bool = False,
+                 keywords: Optional[List[str]] = None, hash_threshold: int = 0,
+                 manifest_file: Optional[str] = None,
+                 codec: str = "png", quality: int = 80, passthrough_size: int = 0,
+                 pipeline: Optional[ImagePipeline] = None, blobs: Optional[BlobStore] = None,
+                 manifest_db: Optional[sqlite3.Connection] = None):
         self.name = name
         self.path = path
         self.creator_id = creator_id
@@ -16,58 +430,335 @@ class Gallery:
         self.compress = compress
         self.duplicate = duplicate
         self.fuzzy = fuzzy
-        self.keywords = []
+        self.keywords = keywords or []
+        # 判定为近似重复的最大汉明距离
+        self.hash_threshold = hash_threshold
+        # 压缩编码：png / webp / webp_lossless / jpeg，小于 passthrough_size 字节的图片保留原图
+        if codec not in CODECS:
+            raise Exception(f"不支持的编码：{codec}，可选：{', '.join(CODECS)}")
+        self.codec = codec
+        self.quality = quality
+        self.passthrough_size = passthrough_size
+        self.pipeline = pipeline or ImagePipeline()
+        # 图片保存在共享存储中，图库目录只用来接收手动放入的图片
+        self.blobs = blobs or BlobStore(os.path.join(os.path.dirname(path), ".blobs"))
         os.makedirs(path, exist_ok=True)
+        # 清单与存储的引用计数保存在同一个数据库中；manifest_file 是需要导入的旧版 JSON 清单
+        if manifest_db is None:
+            manifest_db = sqlite3.connect(self.blobs.db_file, check_same_thread=False)
+        self.manifest = GalleryManifest(manifest_db, name,
+                                        manifest_file or os.path.join(os.path.dirname(path), f"{name}.manifest.json"))
+        self.sync()
+
+    @property
+    def image_count(self) -> int:
+        return len(self.manifest)
+
+    @property
+    def variant(self) -> str:
+        """当前压缩参数，同一原图以相同参数存储的结果可以在图库间共用"""
+        if not self.compress:
+            return "raw"
+        return f"{self.codec}:{self.quality}:{self.passthrough_size}"
+
+    def image_path(self, entry: Dict) -> str:
+        """条目对应的图片文件"""
+        return self.blobs.path(entry["blob"])
+
+    def sync(self):
+        """与存储对齐：旧版保存在图库目录中的图片复制到存储，移除文件已丢失的条目
+
+        手动放入图库目录的新图片由 GalleryWatcher 在工作线程中登记，不在这里处理。
+        """
+        missing = []
+        converted = {}
+        for entry in list(self.manifest.entries):
+            if not entry["blob"]:
+                filepath = os.path.join(self.path, entry["filename"])
+                if os.path.exists(filepath):
+                    blob = self.blobs.put_file(filepath, os.path.splitext(entry["filename"])[1])
+                    self.manifest.set_blob(entry, blob, entry["size"] or os.path.getsize(self.blobs.path(blob)))
+                    st = os.stat(filepath)
+                    converted[entry["filename"]] = (st.st_mtime_ns, st.st_size)
+                else:
+                    missing.append(entry["filename"])
+            elif not os.path.exists(self.image_path(entry)):
+                missing.append(entry["filename"])
+        self.manifest.remove_all(missing)
+        # 原文件留在目录中，记为已处理，不会再被当作新放入的图片
+        self.manifest.mark_inbox(converted)
+
+    def read_dropped_files(self, filenames: List[str]) -> List[Tuple[str, str, int, int, str]]:
+        """读取手动放入图库目录的图片，计算哈希后按原样复制到存储，原文件保持不变
+
+        返回 (文件名, 内容哈希, 感知哈希, 大小, blob) 列表，跳过无法识别的文件。
+        只读写文件和存储、不修改清单，可以在工作线程中执行，结果交给 add_dropped_files 登记。
+        """
+        items = []
+        for filename in filenames:
+            filepath = os.path.join(self.path, filename)
+            if filename.startswith(".") or not os.path.isfile(filepath):
+                continue
+            try:
+                with open(filepath, "rb") as f:
+                    data = f.read()
+                sha256, phash = hash_image(data)
+            except Exception:
+                continue
+            blob = self.blobs.put(data, os.path.splitext(filename)[1].lower())
+            items.append((filename, sha256, phash, len(data), blob))
+        return items
+
+    def add_dropped_files(self, items: List[Tuple[str, str, int, int, str]]) -> int:
+        """把 read_dropped_files 的结果登记到清单，文件名已被占用时改名，返回登记的数量
+
+        和 /存图 一样跳过重复的图片，图库已满时不再登记，跳过的图片释放其存储引用。
+        """
+        added = duplicate = full = 0
+        for filename, sha256, phash, size, blob in items:
+            name = filename
+            existing = self.manifest.get(name)
+            if (existing and existing["sha256"] == sha256) or self.find_duplicate(sha256, phash):
+                # 同名同内容的条目已经登记过，或开启了去重且已有相同的图片
+                self.blobs.release([blob])
+                duplicate += 1
+                continue
+            if len(self.manifest) >= self.capacity:
+                self.blobs.release([blob])
+                full += 1
+                continue
+            if existing:
+                stem, ext = os.path.splitext(filename)
+                name = self.manifest.new_filename(stem, ext)
+            self.manifest.add(name, sha256, phash, size, blob)
+            added += 1
+        if duplicate or full:
+            logger.info(f"[KCBXT] 图库【{self.name}】跳过了{duplicate}张重复、{full}张超出容量的手动放入的图片")
+        return added
+
+    def ingest_dir(self) -> int:
+        """一次登记图库目录中尚未处理过的全部图片，用于导入旧版图库，返回登记的数量"""
+        seen = self.manifest.inbox_seen()
+        pending = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if (entry.name.startswith(".") or os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTENSIONS
+                        or not entry.is_file(follow_symlinks=False)):
+                    continue
+                st = entry.stat()
+                if seen.get(entry.name) != (st.st_mtime_ns, st.st_size):
+                    pending[entry.name] = (st.st_mtime_ns, st.st_size)
+        added = self.add_dropped_files(self.read_dropped_files(sorted(pending)))
+        self.manifest.mark_inbox(pending)
+        return added
+
+    def find_duplicate(self, sha256: str, phash: int) -> Optional[str]:
+        """按哈希查找重复图片，不解码已存储的图片"""
+        if not self.duplicate:
+            return None
+        if self.hash_threshold <= 0:
+            # 阈值为 0 时只去除完全相同的图片，纯色等细节很少的不同图片感知哈希可能相同
+            return self.manifest.find_exact(sha256)
+        return self.manifest.find_exact(sha256) or self.manifest.find_similar(phash, self.hash_threshold)
+
+    def _check_capacity(self):
+        if len(self.manifest) >= self.capacity:
+            raise Exception(f"图库【{self.name}】已达到容量上限")
+
+    def _save_image(self, image: bytes, ext: str, label: str, sha256: str, phash: int) -> str:
+        blob = self.blobs.put(image, ext)
+        self.blobs.remember_source(sha256, self.variant, blob, phash)
+        self.manifest.add(self.manifest.new_filename(label, ext), sha256, phash, len(image), blob)
+        return f"图片已添加到图库【{self.name}】中"
+
+    def _add_existing(self, sha256: str, label: str) -> Optional[str]:
+        """其他图库已按相同参数存储过这张图片时直接引用，不再解码和压缩；没有时返回 None"""
+        found = self.blobs.acquire_source(sha256, self.variant)
+        if found is None:
+            return None
+        blob, size, phash = found
+        if self.find_duplicate(sha256, phash):
+            self.blobs.release([blob])
+            return f"图片已存在于图库【{self.name}】中"
+        self.manifest.add(self.manifest.new_filename(label, os.path.splitext(blob)[1]), sha256, phash, size, blob)
+        return f"图片已添加到图库【{self.name}】中"
 
     def add_image(self, image: bytes, label: str = "") -> str:
         """添加图片到图库"""
-        if len(os.listdir(self.path)) >= self.capacity:
-            raise Exception(f"图库【{self.name}】已达到容量上限")
+        self._check_capacity()
         
         # 检查重复
-        if self.duplicate:
-            for filename in os.listdir(self.path):
-                if self._is_same_image(image, os.path.join(self.path, filename)):
-                    return f"图片已存在于图库【{self.name}】中"
+        sha256 = content_hash(image)
+        if self.duplicate and self.manifest.find_exact(sha256):
+            return f"图片已存在于图库【{self.name}】中"
+        result = self._add_existing(sha256, label)
+        if result:
+            return result
+        phash = perceptual_hash(image)
+        if self.find_duplicate(sha256, phash):
+            return f"图片已存在于图库【{self.name}】中"
 
         # 压缩图片
         if self.compress:
-            image = self._compress_image(image)
+            image, ext = compress_image(image, self.codec, self.quality, self.passthrough_size)
+        else:
+            ext = image_extension(image)
 
         # 保存图片
-        filename = f"{label}_{len(os.listdir(self.path)) + 1}.png"
-        filepath = os.path.join(self.path, filename)
-        with open(filepath, "wb") as f:
-            f.write(image)
-        return f"图片已添加到图库【{self.name}】中"
+        return self._save_image(image, ext, label, sha256, phash)
+
+    async def add_image_async(self, image: bytes, label: str = "", sha256: Optional[str] = None) -> str:
+        """添加图片到图库，哈希和压缩在处理管线中执行；已知内容哈希时不再重复计算"""
+        self._check_capacity()
+
+        if sha256 is None:
+            sha256 = await self.pipeline.run(content_hash, image)
+        if self.duplicate and self.manifest.find_exact(sha256):
+            return f"图片已存在于图库【{self.name}】中"
+        result = self._add_existing(sha256, label)
+        if result:
+            return result
+        phash = await self.pipeline.run(perceptual_hash, image)
+        if self.find_duplicate(sha256, phash):
+            return f"图片已存在于图库【{self.name}】中"
+
+        if self.compress:
+            image, ext = await self.pipeline.run(compress_image, image, self.codec, self.quality,
+                                                 self.passthrough_size)
+        else:
+            ext = image_extension(image)
+
+        # 等待压缩期间可能有相同图片或其他图片已入库，保存前再检查一次
+        self._check_capacity()
+        if self.find_duplicate(sha256, phash):
+            return f"图片已存在于图库【{self.name}】中"
+        return self._save_image(image, ext, label, sha256, phash)
+
+    async def add_image_file(self, filepath: str, sha256: Optional[str] = None, label: str = "") -> str:
+        """从文件添加图片；给出下载时算好的内容哈希时，精确重复的图片不会被读取和解码"""
+        self._check_capacity()
+        if sha256 and self.duplicate and self.manifest.find_exact(sha256):
+            return f"图片已存在于图库【{self.name}】中"
+        if sha256:
+            result = self._add_existing(sha256, label)
+            if result:
+                return result
+        image = await self.pipeline.run(read_file, filepath)
+        return await self.add_image_async(image, label, sha256)
+
+    async def import_images(self, images: AsyncIterator[Tuple[str, Optional[bytes]]],
+                            pipeline: Optional[ImagePipeline] = None,
+                            progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict[str, int]:
+        """批量导入 (名称, 内容) 形式的图片，内容为 None 表示超过大小上限
+
+        哈希和压缩在处理管线中并行执行，同时处理的图片数不超过管线的 max_pending；
+        每张图片先按内容哈希去重、复用其他图库已存储的结果，新图片才会解码和压缩。已接受和正在处理的图片数达到容量时停止读取。
+        返回各结果的数量：added、duplicate、failed、too_large，
+        以及图库已满时的 full = 1。
+        """
+        pipeline = pipeline or self.pipeline
+        counts = Counter(added=0, duplicate=0, failed=0, too_large=0)
+        pending = set()
+        processed = 0
+
+        async def handle(name: str, data: bytes):
+            label = os.path.splitext(os.path.basename(name))[0]
+            sha256 = await asyncio.to_thread(content_hash, data)
+            if self.duplicate and self.manifest.find_exact(sha256):
+                counts["duplicate"] += 1
+                return
+            result = self._add_existing(sha256, label)
+            if result is None:
+                try:
+                    phash = await pipeline.run(perceptual_hash, data)
+                except Exception:
+                    counts["failed"] += 1
+                    return
+                if self.find_duplicate(sha256, phash):
+                    counts["duplicate"] += 1
+                    return
+                if self.compress:
+                    data, ext = await pipeline.run(compress_image, data, self.codec, self.quality,
+                                                   self.passthrough_size)
+                else:
+                    ext = image_extension(data)
+                # 并行处理的相同图片可能已先一步入库
+                if self.find_duplicate(sha256, phash):
+                    counts["duplicate"] += 1
+                    return
+                self._save_image(data, ext, label, sha256, phash)
+                counts["added"] += 1
+            elif result.startswith("图片已存在"):
+                counts["duplicate"] += 1
+            else:
+                counts["added"] += 1
+
+        async def wait_one():
+            nonlocal processed
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.discard(task)
+                task.result()
+                processed += 1
+                if progress and processed % IMPORT_PROGRESS_STEP == 0:
+                    await progress(processed)
+
+        try:
+            async for name, data in images:
+                if data is None:
+                    counts["too_large"] += 1
+                    continue
+                # 已入库和正在处理的图片占满容量时，等处理结果出来再判断是否还有空位
+                while pending and (len(pending) >= pipeline.max_pending
+                                   or len(self.manifest) + len(pending) >= self.capacity):
+                    await wait_one()
+                if len(self.manifest) >= self.capacity:
+                    counts["full"] = 1
+                    break
+                pending.add(asyncio.create_task(handle(name, data)))
+            while pending:
+                await wait_one()
+        finally:
+            for task in pending:
+                task.cancel()
+        return dict(counts)
+
+    async def export_images(self, dest: str) -> Tuple[int, int]:
+        """把图库中的图片按清单顺序写入 zip/tar 包，返回 (图片数, 字节数)"""
+        files = [(entry["filename"], self.image_path(entry)) for entry in self.manifest.entries]
+        return await asyncio.to_thread(write_archive, dest, files)
 
     def delete_image(self, index: Optional[int] = None) -> str:
         """删除图库中的图片"""
         if index is None:
-            # 删除整个图库
-            for filename in os.listdir(self.path):
-                os.remove(os.path.join(self.path, filename))
+            # 清空图库只释放引用，文件由后台垃圾回收删除
+            self.blobs.release(entry["blob"] for entry in self.manifest.clear())
+            self.blobs.collect_later()
             return f"图库【{self.name}】已清空"
         
         # 删除指定图片
-        files = sorted(os.listdir(self.path))
-        if 1 <= index <= len(files):
-            os.remove(os.path.join(self.path, files[index - 1]))
+        if 1 <= index <= len(self.manifest):
+            self.remove_images([self.manifest.entries[index - 1]["filename"]])
             return f"已删除图库【{self.name}】中的第{index}张图片"
         return f"图库【{self.name}】中没有第{index}张图片"
 
+    def remove_images(self, filenames: List[str]):
+        """批量删除指定文件名的图片"""
+        self.blobs.release(entry["blob"] for entry in self.manifest.remove_all(filenames))
+        self.blobs.collect_later()
+
     def get_image(self, index: Optional[int] = None) -> Optional[str]:
         """获取图库中的图片"""
-        files = sorted(os.listdir(self.path))
-        if not files:
+        entries = self.manifest.entries
+        if not entries:
             return None
         
         if index is None:
             # 随机返回一张图片
-            return os.path.join(self.path, random.choice(files))
+            return self.image_path(random.choice(entries))
         
-        if 1 <= index <= len(files):
-            return os.path.join(self.path, files[index - 1])
+        if 1 <= index <= len(entries):
+            return self.image_path(entries[index - 1])
         return None
 
     def get_info(self) -> Dict:
@@ -81,59 +772,237 @@ class Gallery:
             "duplicate": self.duplicate,
             "fuzzy": self.fuzzy,
             "keywords": self.keywords,
-            "image_count": len(os.listdir(self.path))
+            "hash_threshold": self.hash_threshold,
+            "codec": self.codec,
+            "quality": self.quality,
+            "passthrough_size": self.passthrough_size,
+            "image_count": self.image_count
         }
 
-    def _compress_image(self, image_data: bytes) -> bytes:
-        """压缩图片"""
-        img = Image.open(io.BytesIO(image_data))
-        if max(img.size) > 512:
-            ratio = 512 / max(img.size)
-            new_size = tuple(int(dim * ratio) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-        output = io.BytesIO()
-        img.save(output, format="PNG", optimize=True)
-        return output.getvalue()
-
-    def _is_same_image(self, image1: bytes, image2_path: str) -> bool:
-        """检查两张图片是否相同"""
-        try:
-            img1 = Image.open(io.BytesIO(image1))
-            img2 = Image.open(image2_path)
-            return img1.size == img2.size and img1.tobytes() == img2.tobytes()
-        except:
-            return False
+async def deduplicate_galleries(galleries: List[Gallery], delete: bool = True,
+                                progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+                                max_workers: Optional[int] = None) -> Dict[str, List[List[str]]]:
+    """批量去重：在进程池中并行计算所有图片的哈希，按图库聚类重复图片
+
+    返回 {图库名: [[保留的文件, 重复文件...], ...]}，delete 为 True 时删除重复文件。
+    """
+    loop = asyncio.get_running_loop()
+    files = {g.name: [(entry["filename"], g.image_path(entry)) for entry in g.manifest.entries] for g in galleries}
+    # 多个条目可能引用同一个文件，每个文件只计算一次
+    paths = {path for names in files.values() for _, path in names}
+    total = len(paths)
+    hashes: Dict[str, Tuple[Optional[str], Optional[int]]] = {}
+    if total:
+        step = max(total // 10, 1)
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = [loop.run_in_executor(pool, hash_image_file, path) for path in paths]
+            for done, future in enumerate(asyncio.as_completed(futures), 1):
+                filepath, sha256, phash = await future
+                hashes[filepath] = (sha256, phash)
+                if progress and (done % step == 0 or done == total):
+                    await progress(done, total)
+
+    result = {}
+    for g in galleries:
+        entries = []
+        for filename, path in files[g.name]:
+            sha256, phash = hashes[path]
+            if sha256 is None:
+                continue
+            entries.append((filename, sha256, phash))
+        groups = cluster_duplicates(entries, g.hash_threshold)
+        if delete:
+            g.remove_images([filename for group in groups for filename in group[1:]])
+        result[g.name] = groups
+    return result
 
 class GalleryManager:
+    """图库管理器，图库元数据和清单保存在 WAL 模式的 SQLite 中，每次修改只写对应的行；
+    所有图库的图片共用 base_dir/.blobs 下按内容寻址的存储。
+
+    多个进程可以共用同一个数据目录，修正引用计数和回收存储只由调用了 set_maintainer(True) 的进程执行。
+    """
+
     def __init__(self, base_dir: str, info_file: str, default_gallery_info: Dict):
         self.base_dir = base_dir
         self.info_file = info_file
+        self.db_file = os.path.splitext(info_file)[0] + ".db"
         self.default_gallery_info = default_gallery_info
+        self.index_dir = os.path.join(os.path.dirname(info_file), "gallery_index")
+        self.pipeline = ImagePipeline()
+        self.blobs = BlobStore(os.path.join(base_dir, ".blobs"), self.db_file)
+        self.blobs.gc_enabled = False
         self.galleries: Dict[str, Gallery] = {}
         self.exact_keywords: List[str] = []
         self.fuzzy_keywords: List[str] = []
+        self.matcher = KeywordMatcher()
+        # 已加载的各图库信息原文，重新加载时用于判断哪些图库有变化
+        self._info_rows: Dict[str, str] = {}
+        self._data_version = None
         os.makedirs(base_dir, exist_ok=True)
+        self._db = self._open_db()
+        # 在工作线程中重新读取清单用的只读连接
+        self._reader = sqlite3.connect(self.db_file, check_same_thread=False)
         self._load_info()
 
+    def _open_db(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_file, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS galleries (name TEXT PRIMARY KEY, info TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        init_manifest_tables(db)
+        return db
+
+    def _migrate_json(self) -> List[str]:
+        """首次加载时把旧版 gallery_info.json 导入数据库，原文件改名为 .bak，返回导入的图库名"""
+        migrated = []
+        with open(self.info_file, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        with self._db:
+            for key in ("exact_keywords", "fuzzy_keywords"):
+                self._db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                                 (key, json.dumps(info.get(key, []), ensure_ascii=False)))
+            for gallery_info in info.get("galleries", []):
+                if not is_valid_gallery_name(gallery_info.get("name", "")):
+                    logger.warning(f"[KCBXT] 跳过名称无效的图库：{gallery_info.get('name')}")
+                    continue
+                gallery_info = {k: v for k, v in gallery_info.items() if k != "image_count"}
+                self._db.execute("INSERT OR REPLACE INTO galleries VALUES (?, ?)",
+                                 (gallery_info["name"], json.dumps(gallery_info, ensure_ascii=False)))
+                migrated.append(gallery_info["name"])
+        os.replace(self.info_file, self.info_file + ".bak")
+        return migrated
+
+    def _ingest_migrated(self, names: List[str]):
+        """登记导入的图库目录中已有的图片，导入后图片数立即正确，不必等热加载分批登记"""
+        for name in names:
+            gallery = self.galleries.get(name)
+            if gallery is not None:
+                count = gallery.ingest_dir()
+                if count:
+                    logger.info(f"[KCBXT] 图库【{name}】导入了目录中的{count}张图片")
+
     def _load_info(self):
         """加载图库信息"""
-        if os.path.exists(self.info_file):
-            with open(self.info_file, "r", encoding="utf-8") as f:
-                info = json.load(f)
-                self.exact_keywords = info.get("exact_keywords", [])
-                self.fuzzy_keywords = info.get("fuzzy_keywords", [])
-                for gallery_info in info.get("galleries", []):
-                    self.galleries[gallery_info["name"]] = Gallery(**gallery_info)
-
-    def _save_info(self):
-        """保存图库信息"""
-        info = {
-            "exact_keywords": self.exact_keywords,
-            "fuzzy_keywords": self.fuzzy_keywords,
-            "galleries": [gallery.get_info() for gallery in self.galleries.values()]
-        }
-        with open(self.info_file, "w", encoding="utf-8") as f:
-            json.dump(info, f, ensure_ascii=False, indent=2)
+        migrated = self._migrate_json() if os.path.exists(self.info_file) else []
+        settings = dict(self._db.execute("SELECT key, value FROM settings"))
+        self.exact_keywords = json.loads(settings.get("exact_keywords", "[]"))
+        self.fuzzy_keywords = json.loads(settings.get("fuzzy_keywords", "[]"))
+        self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        for name, info in self._db.execute("SELECT name, info FROM galleries"):
+            if not is_valid_gallery_name(name):
+                logger.warning(f"[KCBXT] 跳过名称无效的图库：{name}")
+                continue
+            self.galleries[name] = self._build_gallery(json.loads(info))
+            self._info_rows[name] = info
+        for gallery in self.galleries.values():
+            self._index_keywords(gallery)
+        self._sync_keyword_lists()
+        self._ingest_migrated(migrated)
+
+    def set_maintainer(self, enabled: bool):
+        """设置本进程是否负责修正引用计数和回收存储，多个进程共用数据目录时只应有一个进程负责"""
+        self.blobs.gc_enabled = enabled
+        if not enabled:
+            return
+        # 以数据库中全部清单的实际引用为准修正引用计数，然后在后台回收无人引用的图片
+        self.blobs.rebuild_refcounts(Counter(dict(self._db.execute(
+            "SELECT blob, COUNT(*) FROM gallery_images WHERE blob IS NOT NULL GROUP BY blob"))))
+        self.blobs.collect_later()
+
+    async def reload_info(self) -> Dict[str, List[str]]:
+        """其他进程修改了图库数据库，或重新放入了 gallery_info.json 时重新加载图库信息和清单
+
+        只重建新增的图库、移除已删除的图库、更新信息有变化的图库；被其他进程修改过的清单
+        只在工作线程中读取上次加载后写入的条目和移除记录，事件循环上只应用增删。
+        引用计数由修改的进程维护，这里不增减引用。
+        返回 {"added": [...], "removed": [...], "updated": [...], "reloaded": {图库名: (新增数, 移除数)}}，
+        没有变化时均为空。
+        """
+        changes = {"added": [], "removed": [], "updated": [], "reloaded": {}}
+        migrated = self._migrate_json() if os.path.exists(self.info_file) else None
+        # data_version 只在其他连接提交修改后变化，本连接自己的写入不会触发重新加载
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version and migrated is None:
+            return changes
+        self._data_version = version
+        rows = dict(self._db.execute("SELECT name, info FROM galleries"))
+        for name in [name for name in self.galleries if name not in rows]:
+            self.galleries.pop(name)
+            self._info_rows.pop(name, None)
+            self.matcher.remove_target(name)
+            changes["removed"].append(name)
+        for name, info in rows.items():
+            if self._info_rows.get(name) == info or not is_valid_gallery_name(name):
+                continue
+            gallery_info = json.loads(info)
+            gallery = self.galleries.get(name)
+            if gallery is None:
+                # 手动编辑的 gallery_info.json 可能只写了部分字段，其余使用默认值
+                gallery_info = {**self.default_gallery_info, "path": os.path.join(self.base_dir, name),
+                                **gallery_info, "name": name}
+                gallery = self.galleries[name] = self._build_gallery(gallery_info)
+                changes["added"].append(name)
+            else:
+                for key, value in gallery_info.items():
+                    if key not in ("name", "path", "image_count") and hasattr(gallery, key):
+                        setattr(gallery, key, value)
+                changes["updated"].append(name)
+            self._info_rows[name] = info
+            self._index_keywords(gallery)
+        if changes["added"] or changes["removed"] or changes["updated"]:
+            self._sync_keyword_lists()
+        for name, version in self._db.execute("SELECT gallery, version FROM gallery_versions").fetchall():
+            gallery = self.galleries.get(name)
+            if gallery is None or name in changes["added"] or gallery.manifest.version == version:
+                continue
+            reloaded = await gallery.manifest.reload_async(self._reader)
+            if reloaded is not None and self.galleries.get(name) is gallery:
+                changes["reloaded"][name] = reloaded
+        self._ingest_migrated(migrated or [])
+        return changes
+
+    def _index_keywords(self, gallery: Gallery):
+        """按图库当前的匹配模式重新登记其匹配词"""
+        self.matcher.remove_target(gallery.name)
+        for keyword in gallery.keywords:
+            self.matcher.add(keyword, gallery.name, gallery.fuzzy)
+
+    def _sync_keyword_lists(self):
+        """根据匹配器更新精准/模糊匹配词列表，有变化时保存"""
+        exact, fuzzy = self.matcher.exact_keywords, self.matcher.fuzzy_keywords
+        if exact != self.exact_keywords or fuzzy != self.fuzzy_keywords:
+            self.exact_keywords, self.fuzzy_keywords = exact, fuzzy
+            self._save_keywords()
+
+    def _build_gallery(self, gallery_info: Dict) -> Gallery:
+        """根据保存的信息构建图库对象"""
+        gallery_info = {k: v for k, v in gallery_info.items() if k != "image_count"}
+        # 图库目录固定在 base_dir 下，不使用旧版信息中保存的路径
+        gallery_info["path"] = os.path.join(self.base_dir, gallery_info["name"])
+        gallery_info["manifest_file"] = os.path.join(self.index_dir, f"{gallery_info['name']}.json")
+        gallery_info["pipeline"] = self.pipeline
+        gallery_info["blobs"] = self.blobs
+        gallery_info["manifest_db"] = self._db
+        return Gallery(**gallery_info)
+
+    def _save_gallery(self, gallery: Gallery):
+        """保存单个图库的信息"""
+        info = {k: v for k, v in gallery.get_info().items() if k != "image_count"}
+        info = json.dumps(info, ensure_ascii=False)
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO galleries VALUES (?, ?)", (gallery.name, info))
+        self._info_rows[gallery.name] = info
+
+    def _save_keywords(self):
+        """保存精准/模糊匹配词"""
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                             ("exact_keywords", json.dumps(self.exact_keywords, ensure_ascii=False)))
+            self._db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                             ("fuzzy_keywords", json.dumps(self.fuzzy_keywords, ensure_ascii=False)))
 
     def get_gallery(self, name: str) -> Optional[Gallery]:
         """获取图库"""
@@ -141,6 +1010,8 @@ class GalleryManager:
 
     def create_gallery(self, name: str, creator_id: str, creator_name: str) -> Gallery:
         """创建图库"""
+        if not is_valid_gallery_name(name):
+            raise Exception("图库名不能包含“/”“\\”或“..”，也不能以“.”开头")
         if name in self.galleries:
             raise Exception(f"图库【{name}】已存在")
         
@@ -152,9 +1023,9 @@ class GalleryManager:
             "creator_name": creator_name
         })
         
-        gallery = Gallery(**gallery_info)
+        gallery = self._build_gallery(gallery_info)
         self.galleries[name] = gallery
-        self._save_info()
+        self._save_gallery(gallery)
         return gallery
 
     def delete_gallery(self, name: str) -> str:
@@ -162,18 +1033,92 @@ class GalleryManager:
         if name not in self.galleries:
             return f"图库【{name}】不存在"
         
-        gallery = self.galleries[name]
-        for filename in os.listdir(gallery.path):
-            os.remove(os.path.join(gallery.path, filename))
-        os.rmdir(gallery.path)
-        del self.galleries[name]
-        self._save_info()
+        # 只修改元数据并释放引用，图片文件由后台垃圾回收删除
+        gallery = self.galleries.pop(name)
+        self._info_rows.pop(name, None)
+        with self._db:
+            self._db.execute("DELETE FROM galleries WHERE name = ?", (name,))
+        self.blobs.release(gallery.manifest.drop())
+        self.blobs.discard_dir(gallery.path)
+        self.matcher.remove_target(name)
+        self._sync_keyword_lists()
+        self.blobs.collect_later()
         return f"图库【{name}】已删除"
 
+    def update_gallery(self, name: str, **attrs) -> Gallery:
+        """修改图库属性并保存"""
+        gallery = self.galleries.get(name)
+        if not gallery:
+            raise Exception(f"图库【{name}】不存在")
+        for key, value in attrs.items():
+            setattr(gallery, key, value)
+        self._save_gallery(gallery)
+        if "fuzzy" in attrs or "keywords" in attrs:
+            self._index_keywords(gallery)
+            self._sync_keyword_lists()
+        return gallery
+
+    def add_keyword(self, name: str, keyword: str) -> str:
+        """为图库添加匹配词"""
+        gallery = self.galleries.get(name)
+        if not gallery:
+            return f"图库【{name}】不存在"
+        if keyword in gallery.keywords:
+            return f"图库【{name}】已有匹配词【{keyword}】"
+        gallery.keywords.append(keyword)
+        self._save_gallery(gallery)
+        self.matcher.add(keyword, name, gallery.fuzzy)
+        self._sync_keyword_lists()
+        return f"已为图库【{name}】添加{'模糊' if gallery.fuzzy else '精准'}匹配词【{keyword}】"
+
+    def remove_keyword(self, name: str, keyword: str) -> str:
+        """删除图库的匹配词"""
+        gallery = self.galleries.get(name)
+        if not gallery:
+            return f"图库【{name}】不存在"
+        if keyword not in gallery.keywords:
+            return f"图库【{name}】没有匹配词【{keyword}】"
+        gallery.keywords.remove(keyword)
+        self._save_gallery(gallery)
+        self.matcher.remove(keyword, name)
+        self._sync_keyword_lists()
+        return f"已删除图库【{name}】的匹配词【{keyword}】"
+
     def get_gallery_by_keyword(self, keyword: str) -> List[Gallery]:
         """通过关键词获取图库"""
-        return [g for g in self.galleries.values() if keyword in g.keywords]
+        return [self.galleries[name] for name in sorted(self.matcher.targets(keyword)) if name in self.galleries]
+
+    def match_galleries(self, text: str) -> List[Gallery]:
+        """返回消息触发的全部图库：精准匹配词等于整条消息，或消息包含模糊匹配词"""
+        return [self.galleries[name] for name in self.matcher.match(text) if name in self.galleries]
 
     def get_gallery_by_attribute(self, **kwargs) -> List[Gallery]:
         """通过属性获取图库"""
-        return [g for g in self.galleries.values() if all(getattr(g, k) == v for k, v in kwargs.items())] 
\ No newline at end of file
+        return [g for g in self.galleries.values() if all(getattr(g, k) == v for k, v in kwargs.items())]
+
+    async def import_archive(self, name: str, source: str, creator_id: str, creator_name: str,
+                             max_bytes: Optional[int] = None,
+                             progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict[str, int]:
+        """把 zip/tar 包或目录中的图片导入图库（不存在时创建），哈希和压缩在独立的进程池中并行执行"""
+        if not os.path.exists(source):
+            raise Exception(f"路径不存在：{source}")
+        gallery = self.get_gallery(name) or self.create_gallery(name, creator_id, creator_name)
+        pipeline = ImagePipeline(max_workers=os.cpu_count(), use_processes=True)
+        try:
+            return await gallery.import_images(iter_images_async(source, max_bytes), pipeline, progress)
+        finally:
+            pipeline.shutdown()
+
+    async def export_gallery(self, name: str, dest: str) -> Tuple[int, int]:
+        """把图库导出为 zip/tar 包，返回 (图片数, 字节数)"""
+        gallery = self.get_gallery(name)
+        if gallery is None:
+            raise Exception(f"图库【{name}】不存在")
+        return await gallery.export_images(dest)
+
+    def close(self):
+        """释放图片处理工作池并关闭数据库"""
+        self.pipeline.shutdown()
+        self.blobs.close()
+        self._reader.close()
+        self._db.close()
\ No newline at end of file
@@ -0,0 +1,241 @@
+"""
+插件共享的 HTTP 客户端
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import os
+import tempfile
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple, Union
+
+from astrbot.logger import logger
+
+from .lazy import LazyModule
+
+# 第一次发起请求时才导入
+aiohttp = LazyModule("aiohttp")
+
+# 遇到这些状态码时按指数退避重试
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# 各类文件默认的大小上限（字节）
+SIZE_LIMITS = {
+    "image": 10 * 1024 * 1024,
+    "document": 20 * 1024 * 1024,
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# 用于识别文件格式的文件头长度
+SNIFF_BYTES = 16
+
+
+class DownloadTooLarge(Exception):
+    """下载内容超过大小上限"""
+
+
+class UnsupportedFormat(Exception):
+    """文件头识别出的格式不在允许范围内"""
+
+    def __init__(self, fmt: Optional[str]):
+        super().__init__(f"不支持的文件格式：{fmt or '未知'}")
+        self.format = fmt
+
+
+class Download:
+    """流式下载的结果：落盘路径、字节数、边下载边计算的 sha256 和文件头识别出的格式"""
+    __slots__ = ("path", "size", "sha256", "format", "temporary")
+
+    def __init__(self, path: str, size: int, sha256: str, fmt: Optional[str], temporary: bool):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.format = fmt
+        self.temporary = temporary
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def cleanup(self):
+        """删除临时文件"""
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _limit_message(max_bytes: int) -> str:
+    return f"文件超过大小上限 {max_bytes // (1024 * 1024)}MB"
+
+
+MaxBytes = Union[None, int, Dict[str, int]]
+
+
+def _resolve_limit(head: bytes, sniff: Optional[Callable[[bytes], Optional[str]]],
+                   max_bytes: MaxBytes) -> Tuple[Optional[str], Optional[int]]:
+    """识别文件头格式并确定大小上限；max_bytes 为字典时同时作为允许的格式列表"""
+    fmt = sniff(head) if sniff else None
+    if isinstance(max_bytes, dict):
+        if fmt not in max_bytes:
+            raise UnsupportedFormat(fmt)
+        return fmt, max_bytes[fmt]
+    return fmt, max_bytes
+
+
+class _HashingWriter:
+    """写文件的同时计算哈希并检查大小"""
+
+    def __init__(self, f, max_bytes: Optional[int]):
+        self.f = f
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise DownloadTooLarge(_limit_message(self.max_bytes))
+        self.digest.update(chunk)
+        self.f.write(chunk)
+
+
+def _copy_local(src: str, dest: str, max_bytes: MaxBytes,
+                sniff: Optional[Callable[[bytes], Optional[str]]]) -> tuple:
+    """分块复制本地文件并计算哈希"""
+    with open(src, "rb") as fin:
+        head = fin.read(SNIFF_BYTES)
+        fmt, limit = _resolve_limit(head, sniff, max_bytes)
+        if limit is not None and os.fstat(fin.fileno()).st_size > limit:
+            raise DownloadTooLarge(_limit_message(limit))
+        with open(dest, "wb") as fout:
+            writer = _HashingWriter(fout, limit)
+            writer.write(head)
+            while chunk := fin.read(CHUNK_SIZE):
+                writer.write(chunk)
+    return writer.size, writer.digest.hexdigest(), fmt
+
+
+class HttpClient:
+    """插件生命周期内共享的 HTTP 客户端
+
+    复用同一个 ClientSession 的连接池、DNS 缓存和 keep-alive 连接，
+    对连接错误、超时和 RETRY_STATUSES 按 backoff * 2^n 秒退避重试，插件停用时调用 close()。
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 8, timeout: float = 30,
+                 retries: int = 3, backoff: float = 0.5, keepalive_timeout: float = 30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # 会话需要在事件循环中创建，首次请求时再初始化
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=300, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _request(self, method: str, url: str,
+                       data: Union[None, bytes, Callable[[], object]] = None, **kwargs) -> aiohttp.ClientResponse:
+        """发送请求并在可重试的失败上退避重试，返回尚未读取正文的响应
+
+        data 可以是生成请求体的函数，每次重试都会重新生成（FormData 只能发送一次）。
+        """
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            body = data() if callable(data) else data
+            try:
+                resp = await session.request(method, url, data=body, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"[KCBXT] 请求 {url} 失败，准备重试: {e!r}")
+            else:
+                if resp.status not in RETRY_STATUSES or attempt == self.retries:
+                    return resp
+                resp.release()
+                logger.warning(f"[KCBXT] 请求 {url} 返回 {resp.status}，准备重试")
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    @contextlib.asynccontextmanager
+    async def get(self, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """GET 请求，用法：async with http.get(url) as resp: ..."""
+        resp = await self._request("GET", url, **kwargs)
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    @contextlib.asynccontextmanager
+    async def post(self, url: str, data=None, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """POST 请求，data 可以是生成请求体的函数"""
+        resp = await self._request("POST", url, data=data, **kwargs)
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    async def read(self, url: str) -> bytes:
+        """下载并返回响应内容"""
+        async with self.get(url) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def fetch(self, source: str, save_path: Optional[str] = None, max_bytes: MaxBytes = None,
+                    sniff: Optional[Callable[[bytes], Optional[str]]] = None) -> Download:
+        """流式获取 URL 或本地文件到 save_path（未指定时写入临时文件）
+
+        先读取前 SNIFF_BYTES 字节交给 sniff 识别格式；max_bytes 为 {格式: 上限} 字典时，
+        不在字典中的格式立即中止传输并抛出 UnsupportedFormat。之后边读边计算 sha256，
+        超过上限时中止并删除已写入的部分，抛出 DownloadTooLarge。
+        """
+        temporary = save_path is None
+        if temporary:
+            fd, save_path = tempfile.mkstemp(prefix="kcbxt-")
+            os.close(fd)
+        try:
+            if source.startswith("http://") or source.startswith("https://"):
+                size, sha256, fmt = await self._stream_url(source, save_path, max_bytes, sniff)
+            elif os.path.exists(source):
+                size, sha256, fmt = await asyncio.to_thread(_copy_local, source, save_path, max_bytes, sniff)
+            else:
+                raise FileNotFoundError(f"文件处理失败：本地文件不存在或无法直接访问: {source}。可能需要配置对应平台的API来下载文件。")
+        except BaseException:
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            raise
+        return Download(save_path, size, sha256, fmt, temporary)
+
+    async def _stream_url(self, url: str, save_path: str, max_bytes: MaxBytes,
+                          sniff: Optional[Callable[[bytes], Optional[str]]]) -> tuple:
+        async with self.get(url) as resp:
+            resp.raise_for_status()
+            head = b""
+            while len(head) < SNIFF_BYTES:
+                part = await resp.content.read(SNIFF_BYTES - len(head))
+                if not part:
+                    break
+                head += part
+            # 格式不支持时在这里中止，未读取的正文随连接一起丢弃
+            fmt, limit = _resolve_limit(head, sniff, max_bytes)
+            if limit is not None and (resp.content_length or 0) > limit:
+                raise DownloadTooLarge(_limit_message(limit))
+            with open(save_path, "wb") as f:
+                writer = _HashingWriter(f, limit)
+                writer.write(head)
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    writer.write(chunk)
+            return writer.size, writer.digest.hexdigest(), fmt
+
+    async def close(self):
+        """关闭会话和连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
\ No newline at end of file
@@ -0,0 +1,206 @@
+"""
+图片解码、哈希与压缩，以及在工作池中异步执行这些操作的处理管线
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .lazy import LazyModule
+
+# PIL 在第一次处理图片时才导入
+Image = LazyModule("PIL.Image")
+
+# 压缩后的最长边
+MAX_SIZE = 512
+
+# 可选的输出编码：编码名 -> (扩展名, PIL格式)
+CODECS = {
+    "png": (".png", "PNG"),
+    "webp": (".webp", "WEBP"),
+    "webp_lossless": (".webp", "WEBP"),
+    "jpeg": (".jpg", "JPEG"),
+}
+
+# PIL格式 -> 扩展名，用于保留原图时命名
+FORMAT_EXTENSIONS = {
+    "PNG": ".png",
+    "JPEG": ".jpg",
+    "GIF": ".gif",
+    "WEBP": ".webp",
+    "BMP": ".bmp",
+}
+
+
+def content_hash(data: bytes) -> str:
+    """图片内容的精确哈希"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(img: Image.Image, size: int = 8) -> int:
+    """计算图片的差异哈希（dHash），返回 size*size 位整数"""
+    gray = img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = gray.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def open_image(data: bytes, max_size: Optional[int] = None) -> Image.Image:
+    """打开图片；JPEG 会在解码阶段直接缩小到不低于 max_size 的尺寸"""
+    img = Image.open(io.BytesIO(data))
+    if max_size and img.format == "JPEG" and max(img.size) > max_size:
+        img.draft(img.mode, (max_size, max_size))
+    return img
+
+
+def perceptual_hash(data: bytes) -> int:
+    """返回图片的感知哈希"""
+    return dhash(open_image(data, MAX_SIZE))
+
+
+def hash_image(data: bytes) -> Tuple[str, int]:
+    """返回 (内容哈希, 感知哈希)"""
+    return content_hash(data), perceptual_hash(data)
+
+
+def read_file(filepath: str) -> bytes:
+    with open(filepath, "rb") as f:
+        return f.read()
+
+
+def hash_image_file(filepath: str) -> Tuple[str, Optional[str], Optional[int]]:
+    """计算图片文件的 (路径, 内容哈希, 感知哈希)，供进程池调用"""
+    try:
+        with open(filepath, "rb") as f:
+            data = f.read()
+        return (filepath, *hash_image(data))
+    except Exception:
+        return filepath, None, None
+
+
+def image_extension(data: bytes) -> str:
+    """根据图片实际格式返回扩展名，只读取文件头"""
+    try:
+        return FORMAT_EXTENSIONS.get(Image.open(io.BytesIO(data)).format, ".png")
+    except Exception:
+        return ".png"
+
+
+def downscale(img: Image.Image, max_size: int = MAX_SIZE) -> Image.Image:
+    """等比缩小到最长边不超过 max_size"""
+    if max(img.size) <= max_size:
+        return img
+    ratio = max_size / max(img.size)
+    new_size = tuple(int(dim * ratio) for dim in img.size)
+    # reducing_gap 让非 JPEG 图片先用 reduce() 整数倍缩小，再做 LANCZOS
+    return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+
+def encode_image(img: Image.Image, codec: str = "png", quality: int = 80) -> bytes:
+    """按指定编码输出图片"""
+    if codec not in CODECS:
+        raise ValueError(f"不支持的编码：{codec}")
+    output = io.BytesIO()
+    if codec == "png":
+        img.save(output, format="PNG", optimize=True)
+    elif codec == "webp":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        img.save(output, format="WEBP", quality=quality, method=4)
+    elif codec == "webp_lossless":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        img.save(output, format="WEBP", lossless=True, method=4)
+    elif codec == "jpeg":
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def compress_image(data: bytes, codec: str = "png", quality: int = 80, passthrough_size: int = 0,
+                   max_size: int = MAX_SIZE) -> Tuple[bytes, str]:
+    """压缩图片，返回 (图片数据, 扩展名)
+
+    原图不超过 passthrough_size 字节且无需缩放时直接保留原图；
+    未缩放且重新编码后反而更大时也保留原图。
+    """
+    img = open_image(data, max_size)
+    resized = max(img.size) > max_size
+    if not resized and len(data) <= passthrough_size:
+        return data, FORMAT_EXTENSIONS.get(img.format, ".png")
+    original_format = img.format
+    output = encode_image(downscale(img, max_size), codec, quality)
+    if not resized and len(output) >= len(data) and original_format in FORMAT_EXTENSIONS:
+        return data, FORMAT_EXTENSIONS[original_format]
+    return output, CODECS[codec][0]
+
+
+def benchmark_codecs(samples: Iterable[bytes], codecs: Optional[Iterable[str]] = None,
+                     quality: int = 80, max_size: int = MAX_SIZE) -> List[Dict]:
+    """在样本图片上比较各编码的耗时和体积
+
+    返回每种编码的 {"codec", "seconds", "input_bytes", "output_bytes", "ratio"}。
+    """
+    samples = list(samples)
+    input_bytes = sum(len(data) for data in samples)
+    report = []
+    for codec in codecs or CODECS:
+        output_bytes = 0
+        start = time.perf_counter()
+        for data in samples:
+            img = downscale(open_image(data, max_size), max_size)
+            output_bytes += len(encode_image(img, codec, quality))
+        report.append({
+            "codec": codec,
+            "seconds": time.perf_counter() - start,
+            "input_bytes": input_bytes,
+            "output_bytes": output_bytes,
+            "ratio": output_bytes / input_bytes if input_bytes else 0,
+        })
+    return report
+
+
+class ImagePipeline:
+    """有界的图片处理工作池
+
+    所有解码、哈希和压缩都在工作线程（或进程）中执行，不阻塞事件循环；
+    同时排队和执行的任务数不超过 max_pending，超出时调用方在 run() 处等待。
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 use_processes: bool = False):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending or self.max_workers * 2
+        self.use_processes = use_processes
+        self._executor: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(self.max_pending)
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="kcbxt-image")
+        return self._executor
+
+    async def run(self, fn: Callable, *args):
+        """在工作池中执行 fn(*args)"""
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+
+    def shutdown(self):
+        """关闭工作池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+按需导入相关
+"""
+import importlib
+import sys
+import threading
+import time
+import types
+from typing import List
+
+from astrbot.logger import logger
+
+# 所有延迟导入的模块，用于预热
+_registry: List["LazyModule"] = []
+
+
+class LazyModule(types.ModuleType):
+    """首次访问属性时才导入的模块
+
+    用法：pd = LazyModule("pandas")，之后与 import pandas as pd 的用法相同。
+    插件加载时不导入 pandas、PIL 等重型依赖，第一次用到时才导入；
+    prewarm() 可以在后台线程中提前导入全部模块。
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+        _registry.append(self)
+
+    @property
+    def loaded(self) -> bool:
+        return self.__dict__["_module"] is not None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_module"]
+        if module is None:
+            # import_module 自带模块级的锁，多个线程同时导入时只执行一次
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        value = getattr(self._load(), attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def prewarm() -> threading.Thread:
+    """在后台线程中导入全部尚未导入的模块，返回该线程"""
+    def run():
+        start = time.perf_counter()
+        names = []
+        for module in list(_registry):
+            if module.loaded:
+                continue
+            # 同一个库可能在多个模块中各有一个代理，只记录第一次真正导入的
+            imported = module.__name__ in sys.modules
+            try:
+                module._load()
+            except ImportError as e:
+                logger.warning(f"[KCBXT] 预加载 {module.__name__} 失败: {e}")
+                continue
+            if not imported:
+                names.append(module.__name__)
+        if names:
+            logger.info(f"[KCBXT] 已在后台预加载 {', '.join(names)}，耗时 {time.perf_counter() - start:.2f}s")
+
+    thread = threading.Thread(target=run, name="kcbxt-prewarm", daemon=True)
+    thread.start()
+    return thread
\ No newline at end of file
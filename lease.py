@@ -0,0 +1,94 @@
+"""
+多进程选主相关
+"""
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from astrbot.logger import logger
+
+
+class LeaderLease:
+    """基于 SQLite 行的租约选主
+
+    多个进程共用同一个数据库文件，leases 表中每个名称一行，记录持有者和到期时间。
+    run() 每 ttl/3 秒尝试续约或接管：行不存在、持有者是自己或租约已过期时写入成功即为主进程。
+    主进程异常退出后租约在 ttl 秒内过期，其他进程随即接管；正常退出时调用 release() 立即让出。
+    """
+
+    def __init__(self, db_file: str, name: str, ttl: float = 15,
+                 on_elected: Optional[Callable[[], Awaitable[None]]] = None,
+                 on_demoted: Optional[Callable[[], Awaitable[None]]] = None):
+        self.db_file = db_file
+        self.name = name
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="kcbxt-lease")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.db_file, timeout=self.ttl / 3)
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:
+                db.execute("""CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL)""")
+            self._db = db
+        return self._db
+
+    def _acquire(self) -> bool:
+        db = self._connect()
+        now = time.time()
+        with db:
+            cur = db.execute("""INSERT INTO leases VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?""",
+                             (self.name, self.holder, now + self.ttl, now))
+        return cur.rowcount == 1
+
+    def _release(self):
+        if self._db is None:
+            return
+        with self._db:
+            self._db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+        self._db.close()
+        self._db = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def run(self):
+        """选主循环：成为主进程时调用 on_elected，失去租约时调用 on_demoted"""
+        while True:
+            try:
+                held = await self._run(self._acquire)
+            except sqlite3.Error as e:
+                # 数据库繁忙时无法确认租约，按未持有处理，避免两个进程同时发送
+                logger.warning(f"[KCBXT] 续约失败: {e}")
+                held = False
+            if held != self.is_leader:
+                self.is_leader = held
+                logger.info(f"[KCBXT] {self.holder} {'成为' if held else '不再是'}{self.name}主进程")
+                callback = self.on_elected if held else self.on_demoted
+                if callback is not None:
+                    try:
+                        await callback()
+                    except Exception as e:
+                        logger.error(f"[KCBXT] 切换{self.name}主进程失败: {e}")
+            await asyncio.sleep(self.ttl / 3)
+
+    def release(self):
+        """让出租约并关闭数据库，其他进程下一次尝试时即可接管"""
+        self.is_leader = False
+        self._executor.submit(self._release)
+        self._executor.shutdown(wait=True)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+关键词匹配相关
+"""
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+
+class KeywordMatcher:
+    """多模式关键词匹配器
+
+    精准匹配词放在哈希表里，整条消息等于匹配词时命中；模糊匹配词构建成 Aho-Corasick 自动机，
+    消息中包含匹配词即命中，一次扫描消息就能找出所有图库的匹配词。
+    增删匹配词只修改字典树和输出，失败指针在下一次匹配前按需重新计算。
+    """
+
+    def __init__(self):
+        # 匹配词 -> 对应的目标（图库名）
+        self._exact: Dict[str, Set[str]] = {}
+        self._fuzzy: Dict[str, Set[str]] = {}
+        # 字典树：转移、失败指针、结点对应的匹配词、沿失败链最近的有输出结点
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Optional[str]] = [None]
+        self._dict_link: List[int] = [-1]
+        self._dirty = False
+
+    def add(self, keyword: str, target: str, fuzzy: bool = False):
+        """为目标添加匹配词"""
+        if not keyword:
+            return
+        if not fuzzy:
+            self._exact.setdefault(keyword, set()).add(target)
+            return
+        targets = self._fuzzy.get(keyword)
+        if targets is None:
+            targets = self._fuzzy[keyword] = set()
+            self._insert(keyword)
+        targets.add(target)
+
+    def remove(self, keyword: str, target: str):
+        """移除目标的匹配词（精准和模糊都会移除）"""
+        targets = self._exact.get(keyword)
+        if targets is not None:
+            targets.discard(target)
+            if not targets:
+                del self._exact[keyword]
+        targets = self._fuzzy.get(keyword)
+        if targets is not None:
+            targets.discard(target)
+            if not targets:
+                del self._fuzzy[keyword]
+                self._out[self._find(keyword)] = None
+                self._dirty = True
+
+    def remove_target(self, target: str):
+        """移除目标的全部匹配词"""
+        for keyword in [k for k, targets in self._exact.items() if target in targets]:
+            self.remove(keyword, target)
+        for keyword in [k for k, targets in self._fuzzy.items() if target in targets]:
+            self.remove(keyword, target)
+
+    def targets(self, keyword: str) -> Set[str]:
+        """使用该匹配词的全部目标"""
+        return self._exact.get(keyword, set()) | self._fuzzy.get(keyword, set())
+
+    @property
+    def exact_keywords(self) -> List[str]:
+        return sorted(self._exact)
+
+    @property
+    def fuzzy_keywords(self) -> List[str]:
+        return sorted(self._fuzzy)
+
+    def match(self, text: str) -> List[str]:
+        """返回消息命中的全部目标，按匹配词在消息中出现的顺序排列，精准匹配在前"""
+        result: Dict[str, None] = {}
+        for target in sorted(self._exact.get(text.strip(), ())):
+            result[target] = None
+        if self._fuzzy:
+            if self._dirty:
+                self._build()
+            goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict_link
+            state = 0
+            for ch in text:
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                node = state if out[state] is not None else dict_link[state]
+                while node > 0:
+                    for target in sorted(self._fuzzy[out[node]]):
+                        result[target] = None
+                    node = dict_link[node]
+        return list(result)
+
+    def _find(self, keyword: str) -> int:
+        state = 0
+        for ch in keyword:
+            state = self._goto[state][ch]
+        return state
+
+    def _insert(self, keyword: str):
+        state = 0
+        for ch in keyword:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+                self._dict_link.append(-1)
+            state = nxt
+        self._out[state] = keyword
+        self._dirty = True
+
+    def _build(self):
+        """按层遍历字典树，重新计算失败指针和输出链接"""
+        goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict_link
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            dict_link[child] = -1
+            queue.append(child)
+        while queue:
+            state = queue.popleft()
+            for ch, child in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0)
+                link = fail[child]
+                dict_link[child] = link if out[link] is not None else dict_link[link]
+                queue.append(child)
+        self._dirty = False
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+图片识别（OCR）结果缓存与请求调度
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .http_client import HttpClient
+from .parser import parse_ocr_text, recognize_image, recognize_images
+from .ratelimit import TokenBucket
+
+
+class OcrQueueFull(Exception):
+    """等待识别的图片过多"""
+
+
+class OcrCache:
+    """识别结果的持久化缓存（SQLite）
+
+    以 sha256(图片内容哈希 + 接口地址) 为键，保存原始识别文字和解析出的课程列表；
+    条目数超过 max_entries 时按最近使用时间淘汰，超过 ttl 秒的条目视为过期。
+    """
+
+    def __init__(self, db_file: str, max_entries: int = 5000, ttl: float = 30 * 86400):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="kcbxt-ocr-cache")
+        self._executor.submit(self._init_db)
+
+    def _init_db(self):
+        db = sqlite3.connect(self.db_file)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute("""CREATE TABLE IF NOT EXISTS ocr_cache (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                courses TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0)""")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache (last_used)")
+        self._db = db
+
+    @staticmethod
+    def make_key(content_hash: str, ocr_api_url: str) -> str:
+        return hashlib.sha256(f"{content_hash}\n{ocr_api_url}".encode("utf-8")).hexdigest()
+
+    def _get(self, key: str) -> Optional[Tuple[str, List[Dict]]]:
+        row = self._db.execute("SELECT text, courses, created_at FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        with self._db:
+            if now - row[2] > self.ttl:
+                self._db.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE ocr_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        return row[0], json.loads(row[1])
+
+    def _put(self, key: str, text: str, courses: List[Dict]):
+        now = time.time()
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO ocr_cache (key, text, courses, created_at, last_used) "
+                             "VALUES (?, ?, ?, ?, ?)", (key, text, json.dumps(courses, ensure_ascii=False), now, now))
+            count = self._db.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute("DELETE FROM ocr_cache WHERE key IN "
+                                 "(SELECT key FROM ocr_cache ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def _stats(self) -> Dict:
+        entries, saved = self._db.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM ocr_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "saved_total": saved}
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get(self, content_hash: str, ocr_api_url: str) -> Optional[Tuple[str, List[Dict]]]:
+        """查询缓存，命中时返回 (识别文字, 课程列表)"""
+        cached = await self._run(self._get, self.make_key(content_hash, ocr_api_url))
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    async def put(self, content_hash: str, ocr_api_url: str, text: str, courses: List[Dict]):
+        """写入识别结果"""
+        await self._run(self._put, self.make_key(content_hash, ocr_api_url), text, courses)
+
+    async def stats(self) -> Dict:
+        """本次运行的命中/未命中次数，以及缓存条目数和累计节省的识别次数"""
+        return await self._run(self._stats)
+
+    def close(self):
+        """关闭数据库"""
+        def _close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        self._executor.submit(_close)
+        self._executor.shutdown(wait=False)
+
+
+class OcrDispatcher:
+    """识别请求调度器
+
+    - 同时进行的识别请求不超过 max_in_flight，发起请求前从令牌桶取令牌（每秒 rate 次）；
+    - 相同图片（内容哈希 + 接口地址）的并发请求合并为一次，结果写入 OcrCache；
+    - batch_size > 1 时，batch_window 秒内到达的图片合并为一次批量请求（接口需支持多图上传）；
+    - 等待中的图片超过 max_pending 时直接抛出 OcrQueueFull，由调用方提示稍后再试。
+    """
+
+    def __init__(self, http: HttpClient, cache: OcrCache, max_in_flight: int = 4, rate: float = 5,
+                 max_pending: int = 100, batch_size: int = 1, batch_window: float = 0.2):
+        self.http = http
+        self.cache = cache
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.requests = 0
+        self.coalesced = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._bucket = TokenBucket(rate, max_in_flight)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._batches: Dict[Tuple[str, Optional[str]], List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[Tuple[str, Optional[str]], asyncio.Task] = {}
+        self._tasks = set()
+
+    async def recognize(self, file_path: str, content_hash: str, ocr_api_url: str,
+                        ocr_api_key: Optional[str] = None) -> List[Dict]:
+        """识别图片课程表，返回课程信息列表"""
+        cached = await self.cache.get(content_hash, ocr_api_url)
+        if cached is not None:
+            return cached[1]
+        key = OcrCache.make_key(content_hash, ocr_api_url)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+        if len(self._inflight) >= self.max_pending:
+            raise OcrQueueFull("识别排队的图片过多，请稍后再试")
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            text = await self._submit(file_path, ocr_api_url, ocr_api_key)
+            courses = parse_ocr_text(text)
+            if text:
+                # 接口出错时返回的空结果不缓存，下次重新识别
+                await self.cache.put(content_hash, ocr_api_url, text, courses)
+            future.set_result(courses)
+            return courses
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # 没有合并等待者时避免“异常未被获取”的警告
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _submit(self, file_path: str, ocr_api_url: str, ocr_api_key: Optional[str]) -> str:
+        if self.batch_size <= 1:
+            async with self._slots:
+                await self._bucket.acquire()
+                self.requests += 1
+                return await recognize_image(file_path, ocr_api_url, ocr_api_key, self.http)
+
+        batch_key = (ocr_api_url, ocr_api_key)
+        future = asyncio.get_running_loop().create_future()
+        batch = self._batches.setdefault(batch_key, [])
+        batch.append((file_path, future))
+        if len(batch) >= self.batch_size:
+            # 凑满一批立即发送，之后到达的图片进入新的一批
+            self._spawn(self._flush(batch_key, self._batches.pop(batch_key)))
+            timer = self._timers.pop(batch_key, None)
+            if timer is not None:
+                timer.cancel()
+        elif batch_key not in self._timers:
+            self._timers[batch_key] = self._spawn(self._flush_later(batch_key))
+        return await future
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self, batch_key: Tuple[str, Optional[str]]):
+        await asyncio.sleep(self.batch_window)
+        self._timers.pop(batch_key, None)
+        batch = self._batches.pop(batch_key, None)
+        if batch:
+            await self._flush(batch_key, batch)
+
+    async def _flush(self, batch_key: Tuple[str, Optional[str]], batch: List[Tuple[str, asyncio.Future]]):
+        """发送一批图片，结果按顺序分发给各个等待者"""
+        ocr_api_url, ocr_api_key = batch_key
+        try:
+            async with self._slots:
+                await self._bucket.acquire()
+                self.requests += 1
+                if len(batch) == 1:
+                    texts = [await recognize_image(batch[0][0], ocr_api_url, ocr_api_key, self.http)]
+                else:
+                    texts = await recognize_images([path for path, _ in batch], ocr_api_url, ocr_api_key, self.http)
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for (_, future), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
+
+    def stats(self) -> Dict:
+        """本次运行发出的识别请求数、合并的重复请求数和正在识别的图片数"""
+        return {"requests": self.requests, "coalesced": self.coalesced, "pending": len(self._inflight)}
+
+    def close(self):
+        """取消尚未发送的批量请求"""
+        for task in list(self._tasks):
+            task.cancel()
+        for batch in self._batches.values():
+            for _, future in batch:
+                future.cancel()
+        self._batches.clear()
+        self._timers.clear()
\ No newline at end of file
@@ -1,53 +1,367 @@
 """
 课程表解析相关
 """
-from typing import List, Dict
-import docx
-import aiohttp
+from __future__ import annotations
+
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+import itertools
 import re
 import os
 import json
-import openpyxl
+import zipfile
+from .http_client import HttpClient
+from .lazy import LazyModule
+from .timetable import WEEK_MAP
+
+# 解析后端在第一次解析对应格式时才导入
+aiohttp = LazyModule("aiohttp")
+etree = LazyModule("lxml.etree")
+np = LazyModule("numpy")
+openpyxl = LazyModule("openpyxl")
+pd = LazyModule("pandas")
+
+# WordprocessingML 命名空间，qn("w:t") 与 python-docx 的同名函数结果相同
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def qn(tag: str) -> str:
+    return _W_NS + tag.split(":", 1)[1]
+
+
+# 课程表文件的魔数，docx/xlsx 都是 zip 包，下载完成后再区分
+FILE_SIGNATURES = [
+    (b"PK\x03\x04", "zip"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"BM", "bmp"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "ole"),
+]
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """根据文件头识别格式：zip、png、jpeg、bmp、ole（旧版 .doc/.xls），无法识别返回 None"""
+    for signature, fmt in FILE_SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+def detect_office_format(file_path: str) -> Optional[str]:
+    """区分 zip 包是 docx 还是 xlsx"""
+    with zipfile.ZipFile(file_path) as zf:
+        names = set(zf.namelist())
+    if "word/document.xml" in names:
+        return "docx"
+    if "xl/workbook.xml" in names:
+        return "xlsx"
+    return None
+
+def _row_to_course(cells: List[str]) -> Optional[Dict]:
+    # 假设表格列顺序为：课程名、时间、地点、老师
+    if len(cells) >= 4:
+        return {
+            "course": cells[0],
+            "time": cells[1],
+            "location": cells[2],
+            "teacher": cells[3]
+        }
+    return None
+
+_TEXT_TAGS = {qn("w:t"): None, qn("w:br"): "\n", qn("w:cr"): "\n", qn("w:tab"): "\t"}
+
+def _paragraph_text(p) -> str:
+    parts = []
+    for el in p.iter(*_TEXT_TAGS):
+        if el.tag == qn("w:t"):
+            parts.append(el.text or "")
+        elif el.tag != qn("w:br") or el.get(qn("w:type"), "textWrapping") == "textWrapping":
+            parts.append(_TEXT_TAGS[el.tag])
+    return "".join(parts)
+
+def _cell_text(tc) -> str:
+    # 与 python-docx 的 cell.text 一致：单元格内各段落用换行连接，段内换行符和制表符保留
+    return "\n".join(_paragraph_text(p) for p in tc.iterchildren(qn("w:p")))
+
+# 网格课程表：表头行为星期，首列为节次
+GRID_HEADER_ROWS = 5
+_WEEKDAY_RE = re.compile(r"(?:周|星期|礼拜)([一二三四五六日天])")
+_WEEKDAY_INDEX = {c: i for i, c in enumerate("一二三四五六日")}
+_WEEKDAY_INDEX["天"] = 6
+_NUM = r"[0-9一二三四五六七八九十]+"
+_PERIOD_PATTERNS = (
+    # “第1-2节”“1-2节”“第一节”，“第”可以省略
+    rf"(?:第\s*)?({_NUM})\s*(?:[-~～－—至到、,，]\s*({_NUM}))?\s*节",
+    rf"^\s*({_NUM})\s*(?:[-~～－—至到、,，]\s*({_NUM}))?\s*$",
+)
+_WEEKS_RE = r"[(（\[]?\s*\d+(?:\s*[-~～－—]\s*\d+)?(?:\s*[,，]\s*\d+(?:\s*[-~～－—]\s*\d+)?)*\s*周(?:\s*[(（]?\s*[单双]\s*[)）]?)?\s*[)）\]]?"
+_LOCATION_RE = r"[楼室馆厅场房]|^[A-Za-z]{0,3}[-_]?\d{3,}|机房|实验"
+_CN_DIGITS = {c: i for i, c in enumerate("零一二三四五六七八九")}
+
+
+def _cn_to_int(text: str) -> Optional[int]:
+    """节次数字，支持阿拉伯数字和一到九十九的中文数字"""
+    if not isinstance(text, str) or not text:
+        return None
+    if text.isdigit():
+        return int(text)
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        value = (_CN_DIGITS.get(tens, 0) if tens else 1) * 10 + (_CN_DIGITS.get(ones, 0) if ones else 0)
+        return value
+    return _CN_DIGITS.get(text)
+
+
+def detect_grid_header(row: List[str]) -> Dict[int, int]:
+    """识别网格表头，返回 {列号: 星期序号}；少于三列星期时不认为是网格"""
+    columns = {}
+    for col, cell in enumerate(row):
+        m = _WEEKDAY_RE.search(cell)
+        if m and len(cell) <= 12:
+            columns.setdefault(col, _WEEKDAY_INDEX[m.group(1)])
+    return columns if len(set(columns.values())) >= 3 else {}
+
+
+def _extract_periods(labels: pd.Series) -> pd.DataFrame:
+    """从节次列中提取 (起始节次, 结束节次)，无法识别的为 NaN"""
+    found = pd.DataFrame({"start": np.nan, "end": np.nan}, index=labels.index)
+    for pattern in _PERIOD_PATTERNS:
+        todo = found["start"].isna()
+        if not todo.any():
+            break
+        parts = labels[todo].str.extract(pattern)
+        found.loc[todo, "start"] = parts[0].map(_cn_to_int).astype(float)
+        found.loc[todo, "end"] = parts[1].map(_cn_to_int).astype(float)
+    found["end"] = found["end"].fillna(found["start"])
+    return found
+
+
+def parse_grid(rows: List[List[str]], header_index: int, weekday_columns: Dict[int, int]) -> List[Dict]:
+    """解析网格布局的课程表
+
+    整张表载入 DataFrame 后按列向量化处理：星期列堆叠成一列，空行分隔的多门课程拆开，
+    每门课程按行拆成课程名、周次、地点、老师，最后把同一星期相邻节次的同一课程合并。
+    """
+    width = max(len(r) for r in rows)
+    df = pd.DataFrame([r + [""] * (width - len(r)) for r in rows[header_index + 1:]], dtype=object)
+    if df.empty:
+        return []
+    df = df.fillna("")
+
+    # 节次列：星期列之外，能识别出节次最多的一列；找不到时按行号计节次
+    candidates = [c for c in df.columns if c not in weekday_columns and c < min(weekday_columns)]
+    periods, best = None, 0
+    for col in candidates:
+        extracted = _extract_periods(df[col].astype(str))
+        count = int(extracted["start"].notna().sum())
+        if count > best:
+            periods, best = extracted, count
+    if periods is None:
+        periods = pd.DataFrame({"start": np.arange(1, len(df) + 1, dtype=float)}, index=df.index)
+        periods["end"] = periods["start"]
+
+    cells = df[list(weekday_columns)].rename(columns=weekday_columns)
+    cells = cells.join(periods).dropna(subset=["start"]).set_index(["start", "end"])
+    cells.columns.name = "weekday"
+    stacked = cells.stack().astype(str).str.strip()
+    stacked = stacked[stacked != ""]
+    if stacked.empty:
+        return []
+
+    # 一个单元格里多门课程以空行分隔；单行的课程用空白分隔各字段
+    blocks = stacked.str.split(r"\n\s*\n").explode().str.strip()
+    blocks = blocks[blocks != ""]
+    blocks = blocks.where(blocks.str.contains("\n"), blocks.str.replace(r"\s+", "\n", regex=True))
+    blocks = blocks.reset_index(name="text")
+    blocks.index.name = "block"
+    lines = blocks["text"].str.split(r"\s*\n\s*").explode().str.strip()
+    lines = lines[lines != ""]
+
+    # 每行按内容归类：周次行、首个非周次行为课程名，其余含教室特征的为地点，剩下的为老师
+    is_weeks = lines.str.fullmatch(_WEEKS_RE)
+    is_course = ~is_weeks & ((~is_weeks).groupby(level=0).cumsum() == 1)
+    is_location = ~is_weeks & ~is_course & lines.str.contains(_LOCATION_RE)
+    is_teacher = ~is_weeks & ~is_course & ~is_location
+    weeks = lines[is_weeks].str.replace(r"[\s()（）\[\]]", "", regex=True)
+    records = pd.DataFrame({
+        "course": lines[is_course].groupby(level=0).first(),
+        "weeks": ("(" + weeks + ")").groupby(level=0).first(),
+        "location": lines[is_location].groupby(level=0).first(),
+        "teacher": lines[is_teacher].groupby(level=0).first(),
+    }).reindex(blocks.index)
+    records = blocks[["weekday", "start", "end"]].join(records.fillna(""))
+    records = records[records["course"] != ""]
+    if records.empty:
+        return []
+
+    # 同一星期、相邻节次、字段相同的课程合并为一条
+    keys = ["weekday", "course", "weeks", "location", "teacher"]
+    records = records.sort_values(keys + ["start"], kind="stable")
+    same = (records[keys] == records[keys].shift()).all(axis=1)
+    adjacent = records["start"] <= records["end"].shift() + 1
+    records["group"] = (~(same & adjacent)).cumsum()
+    merged = records.groupby("group").agg(
+        weekday=("weekday", "first"), start=("start", "min"), end=("end", "max"),
+        course=("course", "first"), weeks=("weeks", "first"),
+        location=("location", "first"), teacher=("teacher", "first"))
+    merged = merged.sort_values(["weekday", "start"], kind="stable")
+
+    start = merged["start"].astype(int).astype(str)
+    end = merged["end"].astype(int).astype(str)
+    span = start.where(start == end, start + "-" + end)
+    days = pd.Series(np.array(WEEK_MAP, dtype=object)[merged["weekday"].to_numpy(dtype=int)], index=merged.index)
+    times = days + "第" + span + "节" + merged["weeks"]
+    return [
+        {"course": course, "time": time_str, "location": location, "teacher": teacher}
+        for course, time_str, location, teacher in zip(
+            merged["course"], times, merged["location"], merged["teacher"])
+    ]
+
+
+def iter_table_courses(rows: Iterable[List[str]]) -> Iterator[Dict]:
+    """从表格的行（含表头）中产出课程
+
+    前 GRID_HEADER_ROWS 行中出现星期表头时按网格布局整表解析，
+    否则按“课程名、时间、地点、老师”的列表格式逐行流式解析（首行为表头）。
+    """
+    rows = iter(rows)
+    head = list(itertools.islice(rows, GRID_HEADER_ROWS))
+    for index, row in enumerate(head):
+        weekday_columns = detect_grid_header(row)
+        if weekday_columns:
+            yield from parse_grid(head + list(rows), index, weekday_columns)
+            return
+    for cells in itertools.chain(head[1:], rows):  # 跳过表头
+        course = _row_to_course(cells)
+        if course:
+            yield course
+
+
+def iter_word_rows(file_path: str) -> Iterator[Tuple[int, List[str]]]:
+    """逐行读取Word文档正文中各表格的单元格文字，产出 (表格序号, 单元格列表)
+
+    直接流式解析 word/document.xml，处理完一行即释放，不构建整个文档对象；
+    横向合并的单元格按所跨列数重复，纵向合并的单元格沿用上一行的文字。
+    """
+    tbl_tag, tr_tag, tc_tag = qn("w:tbl"), qn("w:tr"), qn("w:tc")
+    with zipfile.ZipFile(file_path) as zf, zf.open("word/document.xml") as f:
+        depth = 0
+        table_no = -1
+        above: List[str] = []
+        for event, elem in etree.iterparse(f, events=("start", "end"), tag=(tbl_tag, tr_tag)):
+            if elem.tag == tbl_tag:
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        table_no += 1
+                        above = []
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        elem.clear()
+                        while elem.getprevious() is not None:
+                            del elem.getparent()[0]
+                continue
+            # 只处理最外层表格的行，嵌套表格的文字随所在单元格一起读取
+            if event != "end" or depth != 1:
+                continue
+            cells: List[str] = []
+            for tc in elem.iterchildren(tc_tag):
+                tc_pr = tc.find(qn("w:tcPr"))
+                span, merged = 1, False
+                if tc_pr is not None:
+                    grid_span = tc_pr.find(qn("w:gridSpan"))
+                    if grid_span is not None:
+                        span = int(grid_span.get(qn("w:val"), 1))
+                    v_merge = tc_pr.find(qn("w:vMerge"))
+                    merged = v_merge is not None and v_merge.get(qn("w:val"), "continue") == "continue"
+                col = len(cells)
+                text = above[col] if merged and col < len(above) else _cell_text(tc).strip()
+                cells.extend([text] * span)
+            above = cells
+            yield table_no, cells
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def iter_word_courses(file_path: str) -> Iterator[Dict]:
+    """逐条产出Word课程表中的课程，每个表格分别判断是列表还是网格布局"""
+    for _, rows in itertools.groupby(iter_word_rows(file_path), key=lambda item: item[0]):
+        yield from iter_table_courses(cells for _, cells in rows)
 
 def parse_word(file_path: str) -> List[Dict]:
     """解析Word课程表，返回课程信息列表"""
-    result = []
-    doc = docx.Document(file_path)
-    for table in doc.tables:
-        for row in table.rows[1:]:  # 跳过表头
-            cells = [cell.text.strip() for cell in row.cells]
-            # 假设表格列顺序为：课程名、时间、地点、老师
-            if len(cells) >= 4:
-                result.append({
-                    "course": cells[0],
-                    "time": cells[1],
-                    "location": cells[2],
-                    "teacher": cells[3]
-                })
-    return result
+    return list(iter_word_courses(file_path))
 
-async def parse_image(file_path: str, ocr_api_url: str, ocr_api_key: str = None) -> List[Dict]:
-    """通过API接口识别图片课程表，返回课程信息列表"""
-    result = []
-    # 读取图片为二进制
-    with open(file_path, "rb") as f:
-        img_bytes = f.read()
+async def recognize_image(file_path: str, ocr_api_url: str, ocr_api_key: str = None,
+                          http: Optional[HttpClient] = None) -> str:
+    """调用识别API，返回图片中的文字"""
     headers = {}
     if ocr_api_key:
         headers["Authorization"] = ocr_api_key
-    data = aiohttp.FormData()
-    data.add_field('image', img_bytes, filename=os.path.basename(file_path), content_type='application/octet-stream')
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ocr_api_url, headers=headers, data=data) as resp:
+
+    def make_form():
+        # 直接以文件对象作为字段，由 aiohttp 分块上传，不把整张图片读入内存
+        data = aiohttp.FormData()
+        data.add_field('image', open(file_path, "rb"), filename=os.path.basename(file_path), content_type='application/octet-stream')
+        return data
+
+    client = http or HttpClient()
+    try:
+        async with client.post(ocr_api_url, headers=headers, data=make_form) as resp:
             resp_json = await resp.json()
             # 假设API返回格式为{"text": "..."} 或 {"data": {"text": "..."}}
-            text = resp_json.get("text") or resp_json.get("data", {}).get("text", "")
+            return resp_json.get("text") or resp_json.get("data", {}).get("text", "")
+    finally:
+        if http is None:
+            await client.close()
+
+async def recognize_images(file_paths: List[str], ocr_api_url: str, ocr_api_key: str = None,
+                           http: Optional[HttpClient] = None) -> List[str]:
+    """批量调用识别API，一次上传多张图片，按顺序返回每张图片的文字"""
+    headers = {}
+    if ocr_api_key:
+        headers["Authorization"] = ocr_api_key
+
+    def make_form():
+        data = aiohttp.FormData()
+        for file_path in file_paths:
+            data.add_field('image', open(file_path, "rb"), filename=os.path.basename(file_path), content_type='application/octet-stream')
+        return data
+
+    client = http or HttpClient()
+    try:
+        async with client.post(ocr_api_url, headers=headers, data=make_form) as resp:
+            resp_json = await resp.json()
+            # 假设批量接口返回格式为{"results": [{"text": "..."}, ...]}
+            results = resp_json.get("results") or resp_json.get("data", {}).get("results") or []
+            if len(results) != len(file_paths):
+                raise Exception(f"批量识别返回了 {len(results)} 条结果，应为 {len(file_paths)} 条")
+            return [r if isinstance(r, str) else (r.get("text") or "") for r in results]
+    finally:
+        if http is None:
+            await client.close()
+
+# 文字课程表的一行：课程名 时间 地点 老师
+_COURSE_LINE_RE = re.compile(r'(.+?)\s+(周.第.+?节)\s+(.+?)\s+(.+)')
+_SCHEDULE_HINT_RE = re.compile(r'周.第.+?节')
+SCHEDULE_TEXT_MIN = 8
+SCHEDULE_TEXT_MAX = 20000
+
+def looks_like_schedule(text: str) -> bool:
+    """快速判断文字是否可能是课程表：先按长度和“周”“节”字样排除，再做一次正则搜索"""
+    if not SCHEDULE_TEXT_MIN <= len(text) <= SCHEDULE_TEXT_MAX:
+        return False
+    if "周" not in text or "节" not in text:
+        return False
+    return _SCHEDULE_HINT_RE.search(text) is not None
+
+def parse_ocr_text(text: str) -> List[Dict]:
+    """从识别出的文字中提取课程信息"""
+    result = []
     # 简单正则分割行，假设每行一个课程
     lines = [line.strip() for line in text.split('\n') if line.strip()]
     for line in lines:
         # 尝试用正则提取课程名、时间、地点、老师
         # 例如：高等数学 周一第1-2节 教学楼101 张老师
-        m = re.match(r'(.+?)\s+(周.第.+?节)\s+(.+?)\s+(.+)', line)
+        m = _COURSE_LINE_RE.match(line)
         if m:
             result.append({
                 "course": m.group(1),
@@ -57,23 +371,29 @@ async def parse_image(file_path: str, ocr_api_url: str, ocr_api_key: str = None)
             })
     return result
 
+async def parse_image(file_path: str, ocr_api_url: str, ocr_api_key: str = None,
+                      http: Optional[HttpClient] = None) -> List[Dict]:
+    """通过API接口识别图片课程表，返回课程信息列表"""
+    text = await recognize_image(file_path, ocr_api_url, ocr_api_key, http)
+    return parse_ocr_text(text)
+
+def iter_xlsx_rows(file_path: str) -> Iterator[List[str]]:
+    """以只读模式逐行读取活动工作表的单元格文字（含表头），内存占用与表格大小无关"""
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        for row in ws.iter_rows(values_only=True):
+            yield [str(cell).strip() if cell is not None else '' for cell in row]
+    finally:
+        wb.close()
+
+def iter_xlsx_courses(file_path: str) -> Iterator[Dict]:
+    """逐条产出xlsx课程表中的课程"""
+    yield from iter_table_courses(iter_xlsx_rows(file_path))
+
 def parse_xlsx(file_path: str) -> List[Dict]:
     """解析xlsx课程表，返回课程信息列表"""
-    result = []
-    wb = openpyxl.load_workbook(file_path)
-    ws = wb.active
-    for i, row in enumerate(ws.iter_rows(values_only=True)):
-        if i == 0:
-            continue  # 跳过表头
-        cells = [str(cell).strip() if cell is not None else '' for cell in row]
-        if len(cells) >= 4:
-            result.append({
-                "course": cells[0],
-                "time": cells[1],
-                "location": cells[2],
-                "teacher": cells[3]
-            })
-    return result
+    return list(iter_xlsx_courses(file_path))
 
 def parse_text_schedule(text_content: str) -> List[Dict]:
     """解析纯文本课程表，返回课程信息列表"""
@@ -83,7 +403,7 @@ def parse_text_schedule(text_content: str) -> List[Dict]:
         # 尝试用正则提取课程名、时间、地点、老师
         # 示例格式：课程名 时间 地点 老师
         # 例如：高等数学 周一第1-2节 教学楼101 张老师
-        m = re.match(r'(.+?)\s+(周.第.+?节)\s+(.+?)\s+(.+)', line)
+        m = _COURSE_LINE_RE.match(line)
         if m:
             result.append({
                 "course": m.group(1),
@@ -0,0 +1,36 @@
+"""
+限速相关
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """令牌桶限速器
+
+    每秒补充 rate 个令牌，最多积攒 capacity 个；rate <= 0 表示不限速。
+    acquire() 在令牌不足时等待，多个调用方按到达顺序取得令牌。
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        """取得 tokens 个令牌，不足时等待补充"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
\ No newline at end of file
@@ -1,7 +1,243 @@
 """
 定时提醒相关
 """
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
-def schedule_reminders():
-    """定时调度提醒任务（预留）"""
-    pass 
\ No newline at end of file
+from astrbot.logger import logger
+
+from .ratelimit import TokenBucket
+from .timetable import DEFAULT_BELLS, MAX_WEEKS, BellSchedule, parse_course_time, week_of
+
+# 提前10分钟提醒
+REMIND_AHEAD = 600
+
+
+def get_course_slots(time_str: str, bells: BellSchedule) -> List[Tuple[int, Tuple[int, int], int]]:
+    """解析课程时间，返回 [(星期序号, (时, 分), 周次掩码), ...]"""
+    result = []
+    for slot in parse_course_time(time_str):
+        class_time = bells.start_of(slot.period_start)
+        if class_time:
+            result.append((slot.weekday, class_time, slot.week_mask))
+    return result
+
+
+def next_class_time(weekday: int, class_time: Tuple[int, int], after: datetime.datetime, week_mask: int = 0,
+                    term_start: Optional[datetime.date] = None) -> Optional[datetime.datetime]:
+    """计算 after 之后最近一次上课时间，跳过没有课的教学周；之后不再有课时返回 None"""
+    days = (weekday - after.weekday()) % 7
+    class_dt = (after + datetime.timedelta(days=days)).replace(
+        hour=class_time[0], minute=class_time[1], second=0, microsecond=0)
+    if class_dt <= after:
+        class_dt += datetime.timedelta(days=7)
+    if not week_mask or term_start is None:
+        return class_dt
+    while True:
+        week = week_of(class_dt.date(), term_start)
+        if week > MAX_WEEKS:
+            return None
+        if week >= 1 and week_mask >> week & 1:
+            return class_dt
+        class_dt += datetime.timedelta(days=7)
+
+
+class ReminderEntry:
+    """一条待发送的上课提醒"""
+    __slots__ = ("user_id", "course", "unified_msg_origin", "weekday", "class_time", "week_mask", "class_dt",
+                 "version")
+
+    def __init__(self, user_id: str, course: Dict, unified_msg_origin: str, weekday: int,
+                 class_time: Tuple[int, int], week_mask: int, class_dt: datetime.datetime, version: int):
+        self.user_id = user_id
+        self.course = course
+        self.unified_msg_origin = unified_msg_origin
+        self.weekday = weekday
+        self.class_time = class_time
+        self.week_mask = week_mask
+        self.class_dt = class_dt
+        self.version = version
+
+    @property
+    def fire_time(self) -> float:
+        return self.class_dt.timestamp() - REMIND_AHEAD
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        """提醒的唯一标识 (用户, 课程, 上课时间)，用于保证同一节课只提醒一次"""
+        c = self.course
+        return self.user_id, f"{c.get('course', '')}\t{c.get('time', '')}", self.class_dt.isoformat(timespec="minutes")
+
+
+class ReminderScheduler:
+    """基于最小堆的上课提醒调度器
+
+    启动时一次性构建所有用户的 (提醒时间, 用户, 课程) 堆，课程表保存时增量更新，
+    调度循环只睡眠到下一条提醒到期，不再轮询扫描磁盘。上课时间按作息表 bells 计算，
+    设置了开学日期 term_start 时跳过课程不上的教学周。
+    """
+
+    def __init__(self, on_due: Callable[[List[ReminderEntry]], Awaitable[None]],
+                 bells: Optional[BellSchedule] = None, term_start: Optional[datetime.date] = None):
+        self.on_due = on_due
+        self.bells = bells or BellSchedule.parse(DEFAULT_BELLS)
+        self.term_start = term_start
+        self._heap: List[Tuple[float, int, ReminderEntry]] = []
+        self._seq = itertools.count()
+        self._versions: Dict[str, int] = {}
+        self._counts: Dict[str, int] = {}
+        self._wakeup = asyncio.Event()
+
+    def load(self, tables: Iterable[Tuple[str, Dict]]):
+        """批量加载课程表，已经增量更新过的用户不会被覆盖"""
+        now = datetime.datetime.now()
+        for user_id, table in tables:
+            if user_id in self._versions:
+                continue
+            self._add_user(user_id, table.get("courses", []), table.get("unified_msg_origin"), now)
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def update_user(self, user_id: str, courses: List[Dict], unified_msg_origin: Optional[str]):
+        """用户课程表变更后替换其全部提醒"""
+        self._add_user(user_id, courses, unified_msg_origin, datetime.datetime.now(), push=True)
+        self._compact()
+        self._wakeup.set()
+
+    def remove_user(self, user_id: str):
+        """移除用户的全部提醒"""
+        if user_id in self._versions:
+            self._versions[user_id] += 1
+            self._counts[user_id] = 0
+            self._compact()
+
+    def __len__(self) -> int:
+        return sum(self._counts.values())
+
+    def _add_user(self, user_id: str, courses: List[Dict], unified_msg_origin: Optional[str],
+                  now: datetime.datetime, push: bool = False):
+        version = self._versions.get(user_id, 0) + 1
+        self._versions[user_id] = version
+        count = 0
+        if unified_msg_origin:
+            for c in courses:
+                for weekday, class_time, mask in get_course_slots(c.get("time", ""), self.bells):
+                    class_dt = next_class_time(weekday, class_time, now, mask, self.term_start)
+                    if class_dt is None:
+                        continue
+                    entry = ReminderEntry(user_id, c, unified_msg_origin, weekday, class_time, mask, class_dt, version)
+                    item = (entry.fire_time, next(self._seq), entry)
+                    if push:
+                        heapq.heappush(self._heap, item)
+                    else:
+                        self._heap.append(item)
+                    count += 1
+        self._counts[user_id] = count
+
+    def _compact(self):
+        """失效条目过多时重建堆"""
+        live = len(self)
+        if len(self._heap) > 2 * live + 64:
+            self._heap = [item for item in self._heap
+                          if item[2].version == self._versions.get(item[2].user_id)]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self, now: float) -> List[ReminderEntry]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, entry = heapq.heappop(self._heap)
+            if entry.version != self._versions.get(entry.user_id):
+                continue
+            # 课程每周重复，发送后排入下一次上课
+            class_dt = next_class_time(entry.weekday, entry.class_time, entry.class_dt, entry.week_mask,
+                                       self.term_start)
+            if class_dt is not None:
+                nxt = ReminderEntry(entry.user_id, entry.course, entry.unified_msg_origin, entry.weekday,
+                                    entry.class_time, entry.week_mask, class_dt, entry.version)
+                heapq.heappush(self._heap, (nxt.fire_time, next(self._seq), nxt))
+            else:
+                self._counts[entry.user_id] -= 1
+            due.append(entry)
+        return due
+
+    async def run(self):
+        """调度循环：发送到期提醒，然后睡眠到下一条提醒"""
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await self.on_due(due)
+                except Exception as e:
+                    logger.error(f"[KCBXT] 发送上课提醒失败: {e}")
+                continue
+            timeout = max(self._heap[0][0] - time.time(), 0) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def format_reminder(entries: List[ReminderEntry]) -> str:
+    """把同一会话的到期提醒合并为一条消息，同一群里多人的相同课程只列一次"""
+    lines: Dict[str, None] = {}
+    for entry in sorted(entries, key=lambda e: e.class_dt):
+        c = entry.course
+        lines[f"{c['course']} {c['time']} {c['location']} {c['teacher']}"] = None
+    if len(lines) == 1:
+        return f"上课提醒：{next(iter(lines))}"
+    return "上课提醒：\n" + "\n".join(lines)
+
+
+class ReminderDispatcher:
+    """上课提醒发送器
+
+    - 到期提醒按 unified_msg_origin 合并，每个会话只发一条消息；
+    - 不同会话并发发送，同时发送的消息不超过 max_concurrency；
+    - 按平台（unified_msg_origin 中第一个冒号前的部分）各自限速，每秒不超过 rate 条；
+    - 发送前在 ledger 中登记 (用户, 课程, 上课时间)，已登记过的提醒不再发送，
+      插件在提醒时间内重启也不会重复提醒；发送失败时撤销登记。
+    """
+
+    def __init__(self, send: Callable[[str, str], Awaitable[None]], ledger, max_concurrency: int = 8,
+                 rate: float = 5):
+        self.send = send
+        self.ledger = ledger
+        self.rate = rate
+        self.sent = 0
+        self.failed = 0
+        self._slots = asyncio.Semaphore(max(max_concurrency, 1))
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _bucket(self, unified_msg_origin: str) -> TokenBucket:
+        platform = unified_msg_origin.split(":", 1)[0]
+        bucket = self._buckets.get(platform)
+        if bucket is None:
+            bucket = self._buckets[platform] = TokenBucket(self.rate, self.rate)
+        return bucket
+
+    async def dispatch(self, due: List[ReminderEntry]):
+        """发送一批到期提醒，全部发送完成后返回"""
+        claimed = set(await self.ledger.claim_reminders(list({entry.key for entry in due})))
+        groups: Dict[str, List[ReminderEntry]] = {}
+        for entry in due:
+            if entry.key in claimed:
+                groups.setdefault(entry.unified_msg_origin, []).append(entry)
+        if groups:
+            await asyncio.gather(*(self._send_group(origin, entries) for origin, entries in groups.items()))
+
+    async def _send_group(self, unified_msg_origin: str, entries: List[ReminderEntry]):
+        async with self._slots:
+            await self._bucket(unified_msg_origin).acquire()
+            try:
+                await self.send(unified_msg_origin, format_reminder(entries))
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"[KCBXT] 发送上课提醒失败: {e}")
+                await self.ledger.release_reminders(list({entry.key for entry in entries}))
+                return
+        self.sent += 1
\ No newline at end of file
@@ -0,0 +1,322 @@
+"""
+课程表存储相关
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from astrbot.logger import logger
+
+from .timetable import WEEK_MAP, parse_course_time
+
+# 旧版本与课程表放在同一目录下的原始上传文件
+UPLOAD_EXTENSIONS = (".docx", ".doc", ".xlsx", ".jpg", ".jpeg", ".png", ".bmp")
+
+# 数据库结构版本，记录在 PRAGMA user_version 中
+SCHEMA_VERSION = 1
+
+# 已发送提醒的记录保留天数
+REMINDER_LOG_DAYS = 7
+
+# 课程表变更记录保留的条数
+CHANGE_LOG_SIZE = 1000
+
+
+def parse_slots(time_str: str) -> List[Tuple[int, int, int, int]]:
+    """解析课程时间，返回 [(星期序号, 起始节次, 结束节次, 周次掩码), ...]"""
+    return [slot.as_row() for slot in parse_course_time(time_str)]
+
+
+class ScheduleStore:
+    """用户课程表存储（SQLite）
+
+    所有数据库操作都在单线程执行器中按提交顺序执行，对外只提供异步接口；
+    创建时若给出 legacy_dir，会先把旧版的 {user_id}.json 一次性导入。
+    每次保存都会在 schedule_changes 中追加一条递增序号的记录，共用数据目录的其他进程据此得知哪些用户的课程表有变化。
+    """
+
+    def __init__(self, db_file: str, legacy_dir: Optional[str] = None, upload_dir: Optional[str] = None):
+        self.db_file = db_file
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="kcbxt-store")
+        self._executor.submit(self._init_db, legacy_dir, upload_dir)
+
+    def _init_db(self, legacy_dir: Optional[str], upload_dir: Optional[str]):
+        db = sqlite3.connect(self.db_file)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute("""CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                unified_msg_origin TEXT,
+                updated_at REAL NOT NULL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS courses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                course TEXT NOT NULL,
+                time TEXT NOT NULL,
+                location TEXT NOT NULL,
+                teacher TEXT NOT NULL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS course_slots (
+                course_id INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                weekday INTEGER NOT NULL,
+                period_start INTEGER NOT NULL,
+                period_end INTEGER NOT NULL,
+                week_mask INTEGER NOT NULL DEFAULT 0)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS reminder_log (
+                user_id TEXT NOT NULL,
+                course TEXT NOT NULL,
+                class_at TEXT NOT NULL,
+                sent_at REAL NOT NULL,
+                PRIMARY KEY (user_id, course, class_at))""")
+            db.execute("""CREATE TABLE IF NOT EXISTS schedule_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_courses_user ON courses (user_id)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_slots_user ON course_slots (user_id)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_slots_time ON course_slots (weekday, period_start, period_end)")
+        self._db = db
+        if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._upgrade()
+        if legacy_dir:
+            self._migrate_legacy(legacy_dir, upload_dir)
+
+    def _upgrade(self):
+        """旧版数据库补充周次列，并按新的时间解析规则重建全部上课时段"""
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(course_slots)")}
+        with self._db:
+            if "week_mask" not in columns:
+                self._db.execute("ALTER TABLE course_slots ADD COLUMN week_mask INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("DELETE FROM course_slots")
+            for course_id, user_id, time_str in self._db.execute("SELECT id, user_id, time FROM courses").fetchall():
+                self._db.executemany("INSERT INTO course_slots VALUES (?, ?, ?, ?, ?, ?)",
+                                     [(course_id, user_id, *slot) for slot in parse_slots(time_str)])
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _migrate_legacy(self, legacy_dir: str, upload_dir: Optional[str]):
+        """导入旧版每用户一个的 JSON 课程表，并把原始上传文件移入 upload_dir"""
+        backup_dir = os.path.join(legacy_dir, "legacy")
+        migrated = 0
+        for file in os.listdir(legacy_dir):
+            path = os.path.join(legacy_dir, file)
+            if not os.path.isfile(path):
+                continue
+            stem, ext = os.path.splitext(file)
+            if ext == ".json":
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        table = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"[KCBXT] 迁移课程表 {file} 失败: {e}")
+                    continue
+                if not isinstance(table, dict) or "courses" not in table:
+                    continue
+                self._save(stem, table["courses"], table.get("unified_msg_origin"))
+                os.makedirs(backup_dir, exist_ok=True)
+                os.replace(path, os.path.join(backup_dir, file))
+                migrated += 1
+            elif ext.lower() in UPLOAD_EXTENSIONS and upload_dir:
+                os.makedirs(upload_dir, exist_ok=True)
+                os.replace(path, os.path.join(upload_dir, file))
+        if migrated:
+            logger.info(f"[KCBXT] 已将 {migrated} 个旧版课程表迁移到 {self.db_file}")
+
+    def _save(self, user_id: str, courses: List[Dict], unified_msg_origin: Optional[str]):
+        with self._db:
+            self._db.execute("DELETE FROM courses WHERE user_id = ?", (user_id,))
+            self._db.execute("DELETE FROM course_slots WHERE user_id = ?", (user_id,))
+            self._db.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                             (user_id, unified_msg_origin, time.time()))
+            for c in courses:
+                cur = self._db.execute(
+                    "INSERT INTO courses (user_id, course, time, location, teacher) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, c.get("course", ""), c.get("time", ""), c.get("location", ""), c.get("teacher", "")))
+                self._db.executemany("INSERT INTO course_slots VALUES (?, ?, ?, ?, ?, ?)",
+                                     [(cur.lastrowid, user_id, *slot) for slot in parse_slots(c.get("time", ""))])
+            cur = self._db.execute("INSERT INTO schedule_changes (user_id) VALUES (?)", (user_id,))
+            self._db.execute("DELETE FROM schedule_changes WHERE seq <= ?", (cur.lastrowid - CHANGE_LOG_SIZE,))
+
+    def _load(self, user_id: str) -> Optional[Dict]:
+        row = self._db.execute("SELECT unified_msg_origin FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        courses = [{"course": r[0], "time": r[1], "location": r[2], "teacher": r[3]} for r in self._db.execute(
+            "SELECT course, time, location, teacher FROM courses WHERE user_id = ? ORDER BY id", (user_id,))]
+        return {"courses": courses, "unified_msg_origin": row[0]}
+
+    def _all_tables(self) -> List[Tuple[str, Dict]]:
+        tables: Dict[str, Dict] = {}
+        for user_id, unified_msg_origin in self._db.execute("SELECT user_id, unified_msg_origin FROM users"):
+            tables[user_id] = {"courses": [], "unified_msg_origin": unified_msg_origin}
+        for user_id, course, time_str, location, teacher in self._db.execute(
+                "SELECT user_id, course, time, location, teacher FROM courses ORDER BY id"):
+            tables[user_id]["courses"].append(
+                {"course": course, "time": time_str, "location": location, "teacher": teacher})
+        return list(tables.items())
+
+    def _courses_at(self, weekday: int, period: int, week: Optional[int]) -> List[Tuple[str, Optional[str], Dict]]:
+        sql = """SELECT DISTINCT c.id, c.user_id, u.unified_msg_origin, c.course, c.time, c.location, c.teacher
+               FROM course_slots s
+               JOIN courses c ON c.id = s.course_id
+               JOIN users u ON u.user_id = s.user_id
+               WHERE s.weekday = ? AND s.period_start <= ? AND s.period_end >= ?"""
+        params = [weekday, period, period]
+        if week is not None and week < 1:
+            # 尚未开学时只有每周都上的课
+            sql += " AND s.week_mask = 0"
+        elif week is not None:
+            sql += " AND (s.week_mask = 0 OR (s.week_mask >> ?) & 1)"
+            params.append(week)
+        rows = self._db.execute(sql + " ORDER BY c.id", params)
+        return [(r[1], r[2], {"course": r[3], "time": r[4], "location": r[5], "teacher": r[6]}) for r in rows]
+
+    def _changes_since(self, seq: Optional[int]) -> Tuple[int, List[str]]:
+        if seq is None:
+            return self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM schedule_changes").fetchone()[0], []
+        rows = self._db.execute("SELECT seq, user_id FROM schedule_changes WHERE seq > ? ORDER BY seq",
+                                (seq,)).fetchall()
+        if not rows:
+            return seq, []
+        return rows[-1][0], list(dict.fromkeys(user_id for _, user_id in rows))
+
+    def _claim_reminders(self, keys: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+        now = time.time()
+        claimed = []
+        with self._db:
+            self._db.execute("DELETE FROM reminder_log WHERE sent_at < ?", (now - REMINDER_LOG_DAYS * 86400,))
+            for key in keys:
+                cur = self._db.execute("INSERT OR IGNORE INTO reminder_log VALUES (?, ?, ?, ?)", (*key, now))
+                if cur.rowcount:
+                    claimed.append(key)
+        return claimed
+
+    def _release_reminders(self, keys: List[Tuple[str, str, str]]):
+        with self._db:
+            self._db.executemany("DELETE FROM reminder_log WHERE user_id = ? AND course = ? AND class_at = ?", keys)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def save(self, user_id: str, courses: List[Dict], unified_msg_origin: Optional[str]):
+        """保存（覆盖）用户课程表"""
+        await self._run(self._save, user_id, courses, unified_msg_origin)
+
+    async def load(self, user_id: str) -> Optional[Dict]:
+        """读取用户课程表，不存在时返回 None"""
+        return await self._run(self._load, user_id)
+
+    async def all_tables(self) -> List[Tuple[str, Dict]]:
+        """读取全部用户课程表，返回 [(user_id, 课程表), ...]"""
+        return await self._run(self._all_tables)
+
+    async def courses_at(self, weekday: int, period: int,
+                         week: Optional[int] = None) -> List[Tuple[str, Optional[str], Dict]]:
+        """查询星期 weekday 第 period 节（给出 week 时限定第 week 周）的全部课程，
+        返回 [(user_id, unified_msg_origin, 课程), ...]"""
+        return await self._run(self._courses_at, weekday, period, week)
+
+    async def changes_since(self, seq: Optional[int] = None) -> Tuple[int, List[str]]:
+        """查询序号 seq 之后课程表有变化的用户，返回 (最新序号, [user_id, ...])；
+        seq 为 None 时只返回当前最新序号"""
+        return await self._run(self._changes_since, seq)
+
+    async def claim_reminders(self, keys: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+        """登记即将发送的提醒 (user_id, 课程, 上课时间)，返回此前未登记过的部分"""
+        return await self._run(self._claim_reminders, keys)
+
+    async def release_reminders(self, keys: List[Tuple[str, str, str]]):
+        """发送失败时撤销登记"""
+        await self._run(self._release_reminders, keys)
+
+    def close(self):
+        """关闭数据库"""
+        def _close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        self._executor.submit(_close)
+        self._executor.shutdown(wait=False)
+
+
+def format_course(c: Dict) -> str:
+    return f"{c['course']} {c['time']} {c['location']} {c['teacher']}\n"
+
+
+class ScheduleView:
+    """解析并归一化后的课程表，附带按星期分组、按节次排序的课程和预渲染的回复文字"""
+    __slots__ = ("courses", "unified_msg_origin", "by_weekday", "table_text", "day_texts", "_week_texts")
+
+    def __init__(self, table: Dict):
+        self.courses: List[Dict] = table["courses"]
+        self.unified_msg_origin: Optional[str] = table.get("unified_msg_origin")
+        # 每天的 [(起始节次, 周次掩码, 课程), ...]
+        self.by_weekday: List[List[Tuple[int, int, Dict]]] = [[] for _ in WEEK_MAP]
+        for c in self.courses:
+            for slot in parse_course_time(c["time"]):
+                self.by_weekday[slot.weekday].append((slot.period_start, slot.week_mask, c))
+        for day in self.by_weekday:
+            day.sort(key=lambda item: item[0])
+        self.table_text = "你的课程表：\n" + "".join(format_course(c) for c in self.courses)
+        self.day_texts = [self._render(weekday, None) for weekday in range(len(WEEK_MAP))]
+        self._week_texts: Dict[Tuple[int, int], str] = {}
+
+    def _render(self, weekday: int, week: Optional[int]) -> str:
+        courses = [c for _, mask, c in self.by_weekday[weekday]
+                   if week is None or not mask or week >= 1 and mask >> week & 1]
+        return (f"你今天({WEEK_MAP[weekday]})的课程：\n"
+                + ("".join(format_course(c) for c in courses) or "今天没有课程！"))
+
+    def day_text(self, weekday: int, week: Optional[int] = None) -> str:
+        """星期 weekday 的课程文字；给出 week 时只列出第 week 周上的课程"""
+        if week is None or all(not mask for _, mask, _ in self.by_weekday[weekday]):
+            return self.day_texts[weekday]
+        key = (weekday, week)
+        text = self._week_texts.get(key)
+        if text is None:
+            text = self._week_texts[key] = self._render(weekday, week)
+        return text
+
+
+class ScheduleCache:
+    """按用户缓存 ScheduleView 的 LRU，未命中时从 ScheduleStore 读取
+
+    没有课程表的用户同样会被缓存，上传课程表时通过 put() 覆盖。
+    """
+
+    _MISSING = object()
+
+    def __init__(self, store: ScheduleStore, maxsize: int = 1024):
+        self.store = store
+        self.maxsize = maxsize
+        self._views: "OrderedDict[str, object]" = OrderedDict()
+
+    async def get(self, user_id: str) -> Optional[ScheduleView]:
+        """获取用户课程表视图，没有课程表时返回 None"""
+        view = self._views.get(user_id)
+        if view is not None:
+            self._views.move_to_end(user_id)
+            return None if view is self._MISSING else view
+        table = await self.store.load(user_id)
+        view = ScheduleView(table) if table is not None else self._MISSING
+        self._remember(user_id, view)
+        return None if view is self._MISSING else view
+
+    def put(self, user_id: str, table: Dict):
+        """用新保存的课程表更新缓存"""
+        self._remember(user_id, ScheduleView(table))
+
+    def invalidate(self, user_id: str):
+        """移除用户的缓存"""
+        self._views.pop(user_id, None)
+
+    def _remember(self, user_id: str, view):
+        self._views[user_id] = view
+        self._views.move_to_end(user_id)
+        while len(self._views) > self.maxsize:
+            self._views.popitem(last=False)
\ No newline at end of file
@@ -0,0 +1,10 @@
+"""
+测试配置：以包的形式导入插件模块，测试中使用 kcbxt.<模块名>
+"""
+import importlib
+import os
+import sys
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(PLUGIN_DIR))
+sys.modules.setdefault("kcbxt", importlib.import_module(os.path.basename(PLUGIN_DIR)))
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+图库去重测试
+"""
+import asyncio
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from kcbxt.gallery import Gallery, cluster_duplicates, deduplicate_galleries
+
+
+def solid_png(color) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def noise_png(seed: int, size: int = 64) -> bytes:
+    rng = random.Random(seed)
+    buf = io.BytesIO()
+    Image.frombytes("RGB", (size, size), bytes(rng.randrange(256) for _ in range(size * size * 3))).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def make_gallery(tmp_path):
+    galleries = []
+
+    def make(**kwargs):
+        gallery = Gallery("g", str(tmp_path / "g"), "1", "tester", compress=False, **kwargs)
+        galleries.append(gallery)
+        return gallery
+
+    yield make
+    for gallery in galleries:
+        gallery.blobs.close()
+
+
+def test_threshold_zero_keeps_distinct_flat_images(make_gallery):
+    gallery = make_gallery()
+    for color in ("red", "blue", "green", "white"):
+        assert "已添加" in gallery.add_image(solid_png(color))
+    assert gallery.image_count == 4
+    assert "已存在" in gallery.add_image(solid_png("red"))
+    assert gallery.image_count == 4
+
+
+def test_threshold_rejects_near_duplicates(make_gallery):
+    gallery = make_gallery(hash_threshold=10)
+    assert "已添加" in gallery.add_image(noise_png(1))
+    # 同一张图以另一种编码保存，内容哈希不同、感知哈希相同
+    img = Image.open(io.BytesIO(noise_png(1)))
+    buf = io.BytesIO()
+    img.save(buf, "BMP")
+    assert "已存在" in gallery.add_image(buf.getvalue())
+    assert "已添加" in gallery.add_image(noise_png(2))
+    assert gallery.image_count == 2
+
+def test_cluster_threshold_zero_groups_by_content_only():
+    # 纯色图片的感知哈希都是 0，但内容不同
+    hashes = [("red.png", "a", 0), ("blue.png", "b", 0), ("red2.png", "a", 0), ("green.png", "c", 0)]
+    assert cluster_duplicates(hashes, 0) == [["red.png", "red2.png"]]
+    assert cluster_duplicates(hashes, 2) == [["red.png", "blue.png", "red2.png", "green.png"]]
+
+
+def test_deduplicate_keeps_distinct_flat_images(make_gallery):
+    gallery = make_gallery(duplicate=False)
+    for color in ("red", "blue", "green", "white", "red"):
+        gallery.add_image(solid_png(color))
+    groups = asyncio.run(deduplicate_galleries([gallery], max_workers=1))
+    assert len(groups["g"]) == 1 and len(groups["g"][0]) == 2
+    assert gallery.image_count == 4
\ No newline at end of file
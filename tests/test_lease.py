@@ -0,0 +1,61 @@
+"""
+多进程选主测试
+"""
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TTL = 1.5
+
+# 子进程持有租约后输出 elected，失去租约时输出 demoted
+CHILD = f"""
+import asyncio, importlib, sys
+sys.path.insert(0, {os.path.dirname(PLUGIN_DIR)!r})
+lease_module = importlib.import_module({os.path.basename(PLUGIN_DIR)!r} + ".lease")
+
+async def report(state):
+    print(state, flush=True)
+
+lease = lease_module.LeaderLease(sys.argv[1], "test", ttl={TTL},
+                                 on_elected=lambda: report("elected"), on_demoted=lambda: report("demoted"))
+asyncio.run(lease.run())
+"""
+
+
+def start(db_file: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-c", CHILD, db_file], stdout=subprocess.PIPE, text=True)
+
+
+def wait_line(proc: subprocess.Popen, timeout: float) -> str:
+    """等待子进程输出一行，超时返回空字符串"""
+    ready, _, _ = select.select([proc.stdout], [], [], timeout)
+    return proc.stdout.readline().strip() if ready else ""
+
+
+def test_follower_takes_over_after_leader_is_killed(tmp_path):
+    db_file = str(tmp_path / "lease.db")
+    leader = start(db_file)
+    follower = None
+    try:
+        assert wait_line(leader, 10) == "elected"
+        follower = start(db_file)
+        # 主进程存活期间跟随进程不会成为主进程
+        assert wait_line(follower, TTL * 2) == ""
+
+        leader.send_signal(signal.SIGKILL)
+        leader.wait()
+        killed_at = time.monotonic()
+        # 租约在 ttl 秒内过期，跟随进程在随后 ttl/3 秒内的下一次尝试中接管
+        assert wait_line(follower, TTL * 4 / 3 + 1) == "elected"
+        assert time.monotonic() - killed_at <= TTL * 4 / 3 + 0.5
+    finally:
+        for proc in (leader, follower):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if proc is not None:
+                proc.stdout.close()
\ No newline at end of file
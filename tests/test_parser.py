@@ -0,0 +1,30 @@
+"""
+课程表解析测试
+"""
+import pytest
+
+pytest.importorskip("pandas")
+
+from kcbxt.parser import iter_table_courses
+
+
+def grid(labels):
+    rows = [["节次", "星期一", "星期二", "星期三"]]
+    for label in labels:
+        rows.append([label, "", "", ""])
+    rows[2][1] = "高等数学\n1-16周\n教学楼A101\n张三"
+    rows[3][3] = "大学英语\n教学楼B202\n李四"
+    return rows
+
+
+@pytest.mark.parametrize("labels", [
+    ["第1-2节", "第3-4节", "第5-6节"],
+    ["1-2节", "3-4节", "5-6节"],
+    ["第一、二节", "第三、四节", "第五、六节"],
+])
+def test_grid_period_labels(labels):
+    courses = list(iter_table_courses(grid(labels)))
+    assert [(c["course"], c["time"], c["location"], c["teacher"]) for c in courses] == [
+        ("高等数学", "周一第3-4节(1-16周)", "教学楼A101", "张三"),
+        ("大学英语", "周三第5-6节", "教学楼B202", "李四"),
+    ]
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+图库热加载测试
+"""
+import asyncio
+import io
+import json
+import os
+import random
+
+import pytest
+from PIL import Image
+
+from kcbxt.gallery import GalleryManager
+from kcbxt.watcher import GalleryWatcher
+
+
+
+def noise_png(seed: int, size: int = 64) -> bytes:
+    rng = random.Random(seed)
+    buf = io.BytesIO()
+    Image.frombytes("RGB", (size, size), bytes(rng.randrange(256) for _ in range(size * size * 3))).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def open_manager(tmp_path) -> GalleryManager:
+    return GalleryManager(str(tmp_path / "galleries"), str(tmp_path / "gallery_info.json"),
+                          {"creator_id": "1", "creator_name": "tester", "compress": False})
+
+
+def check_twice(gm: GalleryManager):
+    # 文件快照连续两次不变才登记
+    async def run():
+        watcher = GalleryWatcher(gm)
+        await watcher.check(full=True)
+        await watcher.check(full=True)
+        watcher.close()
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("name", ["../x", "a/b", "a\\b", ".hidden", ".."])
+def test_create_gallery_rejects_path_names(tmp_path, name):
+    gm = open_manager(tmp_path)
+    with pytest.raises(Exception):
+        gm.create_gallery(name, "1", "tester")
+    assert name not in gm.galleries
+    gm.close()
+
+
+def test_dropped_images_are_copied_once(tmp_path):
+    gm = open_manager(tmp_path)
+    gallery = gm.create_gallery("g", "1", "tester")
+    for i in range(3):
+        with open(os.path.join(gallery.path, f"{i}.png"), "wb") as f:
+            f.write(noise_png(i))
+    check_twice(gm)
+    assert len(gallery.manifest.entries) == 3
+    assert sorted(os.listdir(gallery.path)) == ["0.png", "1.png", "2.png"]
+    gm.close()
+
+    # 重启后原文件不变，不再重复登记
+    gm = open_manager(tmp_path)
+    check_twice(gm)
+    assert len(gm.galleries["g"].manifest.entries) == 3
+    gm.close()
+
+
+def test_symlinked_directory_is_ignored(tmp_path):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "a.png").write_bytes(noise_png(0))
+    gm = open_manager(tmp_path)
+    os.symlink(outside, os.path.join(gm.base_dir, "link"))
+    check_twice(gm)
+    assert "link" not in gm.galleries
+    assert os.listdir(outside) == ["a.png"]
+    gm.close()
+
+def test_dropped_images_respect_duplicate_and_capacity(tmp_path):
+    gm = open_manager(tmp_path)
+    gallery = gm.update_gallery(gm.create_gallery("g", "1", "tester").name, capacity=2)
+    for i, seed in enumerate([0, 0, 1, 2]):
+        with open(os.path.join(gallery.path, f"{i}.png"), "wb") as f:
+            f.write(noise_png(seed))
+    check_twice(gm)
+    assert [entry["filename"] for entry in gallery.manifest.entries] == ["0.png", "2.png"]
+    gm.close()
+
+
+def test_migrated_gallery_ingests_existing_files(tmp_path):
+    base_dir = tmp_path / "galleries"
+    (base_dir / "old").mkdir(parents=True)
+    for i in range(60):
+        (base_dir / "old" / f"{i}.png").write_bytes(noise_png(i, 16))
+    (tmp_path / "gallery_info.json").write_text(json.dumps({"galleries": [
+        {"name": "old", "creator_id": "1", "creator_name": "tester", "capacity": 100, "compress": False},
+        {"name": "../escape", "creator_id": "1", "creator_name": "tester"},
+    ]}), encoding="utf-8")
+    gm = open_manager(tmp_path)
+    # 不等热加载分批登记，导入后图片数立即正确
+    assert list(gm.galleries) == ["old"]
+    assert gm.galleries["old"].image_count == 60
+    gm.close()
+
+def test_reload_reads_only_changed_rows(tmp_path):
+    writer, reader = open_manager(tmp_path), None
+    try:
+        gallery = writer.create_gallery("g", "1", "tester")
+        for i in range(5):
+            gallery.add_image(noise_png(i))
+        reader = open_manager(tmp_path)
+        manifest = reader.galleries["g"].manifest
+        assert len(manifest) == 5
+
+        gallery.add_image(noise_png(5))
+        gallery.remove_images([gallery.manifest.entries[0]["filename"]])
+        version, full, entries, removed = manifest.read_changes(reader._reader, manifest.version)
+        # 只读到新增的一条和移除记录，不重新读取全部条目
+        assert not full and len(entries) == 1 and len(removed) == 1
+        changes = asyncio.run(reader.reload_info())
+        assert changes["reloaded"] == {"g": (1, 1)}
+        assert [e["id"] for e in manifest.entries] == [e["id"] for e in gallery.manifest.entries]
+
+        # 删除后重建的同名图库，尚未读到删除的进程重新读取全部条目
+        writer.delete_gallery("g")
+        gallery = writer.create_gallery("g", "1", "tester")
+        gallery.add_image(noise_png(9))
+        assert manifest.read_changes(reader._reader, manifest.version)[1]
+    finally:
+        writer.close()
+        if reader is not None:
+            reader.close()
\ No newline at end of file
@@ -0,0 +1,143 @@
+"""
+课程时间解析与作息表
+"""
+import datetime
+import functools
+import re
+from typing import List, Optional, Tuple
+
+WEEK_MAP = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
+
+_WEEKDAY_INDEX = {c: i for i, c in enumerate("一二三四五六日")}
+_WEEKDAY_INDEX["天"] = 6
+
+# 教学周上限，周次用整数的二进制位表示（第 n 位为 1 表示第 n 周有课）
+MAX_WEEKS = 60
+
+_DAY = r"(?:周|星期|礼拜)[一二三四五六日天]"
+_RANGE = r"\d+(?:\s*[-~～－—]\s*\d+)?"
+
+# 一段课程时间，如“周一、周三第1-2节(1-8,10-16周单)”
+_TIME_RE = re.compile(
+    rf"(?P<days>{_DAY}(?:\s*[、,，/和及]?\s*{_DAY})*)\s*第?\s*(?P<start>\d+)\s*(?:[-~～－—至到]\s*(?P<end>\d+))?\s*节"
+    rf"(?:\s*[(（\[]?\s*(?:(?P<weeks>{_RANGE}(?:\s*[,，]\s*{_RANGE})*)\s*周)?"
+    # “周”只在单双之后、且不是下一段开头的“周三”时才属于本段
+    r"\s*[(（]?\s*(?:(?P<parity>[单双])\s*(?:周(?![一二三四五六日天]))?)?\s*[)）]?\s*[)）\]]?)?"
+)
+_DAY_RE = re.compile(r"(?:周|星期|礼拜)([一二三四五六日天])")
+_RANGE_RE = re.compile(r"(\d+)(?:\s*[-~～－—]\s*(\d+))?")
+
+# 默认作息表：第1、3、5、7节分别在 08:00、10:00、14:00、16:00 开始
+DEFAULT_BELLS = "08:00,08:50,10:00,10:50,14:00,14:50,16:00,16:50,19:00,19:50,20:40,21:30"
+
+
+class CourseSlot:
+    """课程的一个上课时段：星期、节次范围和上课周次"""
+    __slots__ = ("weekday", "period_start", "period_end", "week_mask")
+
+    def __init__(self, weekday: int, period_start: int, period_end: int, week_mask: int = 0):
+        self.weekday = weekday
+        self.period_start = period_start
+        self.period_end = period_end
+        # 0 表示每周都上
+        self.week_mask = week_mask
+
+    def in_week(self, week: Optional[int]) -> bool:
+        """第 week 周是否有课，week 为 None（未设置开学日期）时视为有课，小于 1（尚未开学）时只有每周都上的课"""
+        if not self.week_mask or week is None:
+            return True
+        return week >= 1 and bool(self.week_mask >> week & 1)
+
+    def as_row(self) -> Tuple[int, int, int, int]:
+        return self.weekday, self.period_start, self.period_end, self.week_mask
+
+    def __eq__(self, other):
+        return isinstance(other, CourseSlot) and self.as_row() == other.as_row()
+
+    def __hash__(self):
+        return hash(self.as_row())
+
+    def __repr__(self):
+        return f"CourseSlot{self.as_row()}"
+
+
+def week_mask(weeks: Optional[str], parity: Optional[str] = None) -> int:
+    """把“1-8,10-16”和单双周转换为周次位掩码，两者都没有时返回 0（每周）"""
+    if not weeks and not parity:
+        return 0
+    mask = 0
+    for m in _RANGE_RE.finditer(weeks or f"1-{MAX_WEEKS}"):
+        start = int(m.group(1))
+        end = int(m.group(2) or start)
+        for week in range(max(start, 1), min(end, MAX_WEEKS) + 1):
+            mask |= 1 << week
+    if parity == "单":
+        mask &= int("10" * (MAX_WEEKS // 2 + 1), 2)
+    elif parity == "双":
+        mask &= int("01" * (MAX_WEEKS // 2 + 1), 2)
+    return mask
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_course_time(time_str: str) -> Tuple[CourseSlot, ...]:
+    """解析课程时间字符串，返回全部上课时段；相同字符串只解析一次
+
+    >>> [slot.as_row()[:3] for slot in parse_course_time("周一第1-2节 周三第5-6节")]
+    [(0, 1, 2), (2, 5, 6)]
+    >>> [slot.as_row()[:3] for slot in parse_course_time("周一第1-2节单 周三第5-6节")]
+    [(0, 1, 2), (2, 5, 6)]
+    >>> [slot.as_row()[:3] for slot in parse_course_time("周一第1-2节(单周) 周三第5-6节(2-8周)")]
+    [(0, 1, 2), (2, 5, 6)]
+    """
+    slots = []
+    for m in _TIME_RE.finditer(time_str or ""):
+        start = int(m.group("start"))
+        end = int(m.group("end") or start)
+        mask = week_mask(m.group("weeks"), m.group("parity"))
+        for day in _DAY_RE.findall(m.group("days")):
+            slots.append(CourseSlot(_WEEKDAY_INDEX[day], start, end, mask))
+    return tuple(slots)
+
+
+class BellSchedule:
+    """作息表：各节课的开始时间
+
+    配置格式为按节次顺序、逗号分隔的“时:分”，如“08:00,08:50,10:00”。
+    """
+
+    def __init__(self, starts: List[Tuple[int, int]]):
+        self.starts = starts
+
+    @classmethod
+    def parse(cls, text: str) -> "BellSchedule":
+        starts = []
+        for item in re.split(r"[,，\s]+", text.strip()):
+            m = re.fullmatch(r"(\d{1,2})[:：](\d{2})", item)
+            if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+                raise Exception(f"作息表格式错误：{item}，应为以逗号分隔的“时:分”，如 08:00,08:50")
+            starts.append((int(m.group(1)), int(m.group(2))))
+        return cls(starts)
+
+    def start_of(self, period: int) -> Optional[Tuple[int, int]]:
+        """第 period 节的开始时间 (时, 分)，超出作息表时返回 None"""
+        if 1 <= period <= len(self.starts):
+            return self.starts[period - 1]
+        return None
+
+    def __str__(self):
+        return ",".join(f"{h:02d}:{m:02d}" for h, m in self.starts)
+
+
+def parse_term_start(text: Optional[str]) -> Optional[datetime.date]:
+    """解析开学日期（第1周内任意一天），未设置时返回 None"""
+    if not text:
+        return None
+    day = datetime.date.fromisoformat(text.strip())
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def week_of(day: datetime.date, term_start: Optional[datetime.date]) -> Optional[int]:
+    """day 是第几个教学周，未设置开学日期时返回 None"""
+    if term_start is None:
+        return None
+    return (day - term_start).days // 7 + 1
\ No newline at end of file
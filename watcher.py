@@ -0,0 +1,244 @@
+"""
+图库热加载相关
+"""
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from astrbot.logger import logger
+
+from .archive import IMAGE_EXTENSIONS
+from .gallery import GalleryManager, is_valid_gallery_name
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# 每个图库每次扫描最多登记的图片数，剩余的紧接着下一次扫描；大量图片请使用 /导入图库
+MAX_INGEST_PER_SCAN = 50
+
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+def scan_dir(path: str) -> Snapshot:
+    """目录中文件的 {文件名: (修改时间, 大小)} 快照，忽略隐藏文件和子目录"""
+    snapshot = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        st = entry.stat()
+                        snapshot[entry.name] = (st.st_mtime_ns, st.st_size)
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return snapshot
+
+
+class GalleryWatcher:
+    """图库热加载
+
+    - 图库目录：比较两次扫描的文件快照，修改时间和大小连续两次不变（或收到 inotify 写入完成事件）的
+      新图片复制到存储并登记到对应图库，原文件保留在目录中，记为已处理后不再重复登记；
+      图库根目录下新出现的目录在其中的图片不再变化后自动创建为图库；
+    - 图库信息和清单：数据库被其他进程修改或重新放入 gallery_info.json 时重新加载，
+      清单只把其他进程增删的条目应用到内存。
+
+    目录的修改时间不变且没有待登记的图片时不列出其中的文件，没有变化的图库每次检查只需一次 stat；
+    读取、解码和复制到存储在图片处理工作池中执行，事件循环上只登记结果，每个图库每次最多登记
+    MAX_INGEST_PER_SCAN 张。只处理真实路径直接位于图库根目录下的目录。安装了 inotify_simple 时
+    由目录事件触发扫描，且只扫描收到事件的目录，interval 只作为兜底的检查间隔。
+    多个进程共用数据目录时，只有 can_ingest() 为真的进程登记图片和创建图库，其余进程只重新加载。
+    """
+
+    def __init__(self, gm: GalleryManager, interval: float = 5, can_ingest: Optional[Callable[[], bool]] = None):
+        self.gm = gm
+        self.interval = interval
+        self.can_ingest = can_ingest
+        self._ingesting = False
+        # 图库名 -> 上次扫描时尚未处理的图片快照
+        self._snapshots: Dict[str, Snapshot] = {}
+        # 图库名 -> 上次扫描时目录的修改时间
+        self._dir_mtimes: Dict[str, Optional[int]] = {}
+        # 尚未创建为图库的新目录 -> 其中图片的快照
+        self._new_dirs: Dict[str, Snapshot] = {}
+        # inotify 报告写入完成、可以直接登记的文件
+        self._ready: Dict[str, Set[str]] = {}
+        self._dirty: Set[str] = set()
+        self._inotify = None
+        self._watches: Dict[int, str] = {}
+        self._wakeup = asyncio.Event()
+
+    def _start_inotify(self):
+        if inotify_simple is None:
+            return
+        try:
+            self._inotify = inotify_simple.INotify()
+        except OSError as e:
+            logger.warning(f"[KCBXT] inotify 不可用，改为定时扫描图库目录: {e}")
+            return
+        asyncio.get_running_loop().add_reader(self._inotify.fileno(), self._on_events)
+        self._watch("")
+
+    def _watch(self, name: str):
+        # 对已监听的目录重复添加会返回原来的编号，目录被删除后重建时则得到新的编号
+        if self._inotify is None:
+            return
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE | flags.MOVED_FROM
+        path = os.path.join(self.gm.base_dir, name) if name else self.gm.base_dir
+        try:
+            wd = self._inotify.add_watch(path, mask)
+        except OSError:
+            return
+        self._watches[wd] = name
+
+    def _on_events(self):
+        flags = inotify_simple.flags
+        for event in self._inotify.read(timeout=0):
+            if event.mask & flags.IGNORED:
+                # 目录已被删除，监听随之失效
+                self._watches.pop(event.wd, None)
+                continue
+            name = self._watches.get(event.wd)
+            if name is None:
+                continue
+            self._dirty.add(name)
+            if name and event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                self._ready.setdefault(name, set()).add(event.name)
+        self._wakeup.set()
+
+    def _in_base_dir(self, path: str) -> bool:
+        """目录的真实路径是否直接位于图库根目录下，不跟随符号链接处理其他位置的文件"""
+        return os.path.dirname(os.path.realpath(path)) == os.path.realpath(self.gm.base_dir)
+
+    async def _scan_gallery(self, name: str) -> int:
+        """登记图库目录中新出现且已写完的图片，返回登记的数量"""
+        gallery = self.gm.galleries.get(name)
+        if gallery is None or not self._in_base_dir(gallery.path):
+            return 0
+        try:
+            dir_mtime = os.stat(gallery.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+        previous = self._snapshots.get(name, {})
+        ready = self._ready.pop(name, set())
+        if not previous and not ready and self._dir_mtimes.get(name) == dir_mtime:
+            # 目录中没有新增、删除或改名的文件
+            return 0
+        # 修改时间的精度有限，刚修改过的目录下次检查时仍要列出文件
+        self._dir_mtimes[name] = dir_mtime if time.time_ns() - dir_mtime > 1_000_000_000 else None
+        seen = gallery.manifest.inbox_seen()
+        current = {filename: stat for filename, stat in scan_dir(gallery.path).items()
+                   if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS and seen.get(filename) != stat}
+        stable = sorted(filename for filename, stat in current.items()
+                        if previous.get(filename) == stat or filename in ready)
+        if len(stable) > MAX_INGEST_PER_SCAN:
+            # 剩余的图片紧接着在下一次检查中登记
+            stable = stable[:MAX_INGEST_PER_SCAN]
+            self._wakeup.set()
+        items = await self.gm.pipeline.run(gallery.read_dropped_files, stable) if stable else []
+        if self.gm.galleries.get(name) is not gallery:
+            # 处理期间图库已被删除，已复制到存储的图片不再登记
+            gallery.blobs.release(item[4] for item in items)
+            gallery.blobs.collect_later()
+            self._snapshots.pop(name, None)
+            self._dir_mtimes.pop(name, None)
+            return 0
+        added = gallery.add_dropped_files(items)
+        # 登记的和无法识别的文件都记为已处理，文件不变时不再读取
+        gallery.manifest.mark_inbox({filename: current.pop(filename) for filename in stable})
+        self._snapshots[name] = current
+        if current:
+            # 仍有写入中或尚未登记的图片，下次检查时再扫描
+            self._dirty.add(name)
+        return added
+
+    def _discover(self) -> List[str]:
+        """把图库根目录下新出现的、图片已经写完的目录创建为图库，返回新建的图库名
+
+        其中的图片随后和其他图库一样分批登记。
+        """
+        creator_id = self.gm.default_gallery_info.get("creator_id", "")
+        creator_name = self.gm.default_gallery_info.get("creator_name", "")
+        new_dirs = {}
+        created = []
+        with os.scandir(self.gm.base_dir) as it:
+            for entry in it:
+                if (entry.name in self.gm.galleries or not is_valid_gallery_name(entry.name)
+                        or not entry.is_dir(follow_symlinks=False) or not self._in_base_dir(entry.path)):
+                    continue
+                images = {filename: stat for filename, stat in scan_dir(entry.path).items()
+                          if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS}
+                if not images:
+                    continue
+                if self._new_dirs.get(entry.name) != images:
+                    # 图片可能还在复制中，下次检查时不再变化才创建
+                    new_dirs[entry.name] = images
+                    continue
+                self.gm.create_gallery(entry.name, creator_id, creator_name)
+                # 图片已经两次扫描不变，本次检查中即可登记
+                self._snapshots[entry.name] = images
+                created.append(entry.name)
+                logger.info(f"[KCBXT] 发现新图库【{entry.name}】，共{len(images)}张图片待登记")
+        self._new_dirs = new_dirs
+        if new_dirs:
+            self._dirty.add("")
+        return created
+
+    async def check(self, full: bool = False) -> Dict[str, int]:
+        """执行一次检查，full 为 True 或没有 inotify 时扫描全部图库目录；返回各图库新登记的图片数"""
+        changes = await self.gm.reload_info()
+        for name, (n_added, n_removed) in changes["reloaded"].items():
+            logger.info(f"[KCBXT] 图库【{name}】清单已被其他进程修改，载入新增{n_added}张、移除{n_removed}张")
+        for name in [name for name in self._snapshots if name not in self.gm.galleries]:
+            self._snapshots.pop(name, None)
+            self._dir_mtimes.pop(name, None)
+        ingest = self.can_ingest is None or self.can_ingest()
+        # 刚开始负责登记时先完整扫描一次
+        full = full or self._inotify is None or (ingest and not self._ingesting)
+        self._ingesting = ingest
+        dirty, self._dirty = self._dirty, set()
+        if ingest and (full or "" in dirty):
+            dirty.update(self._discover())
+        added = {}
+        for name, gallery in list(self.gm.galleries.items()):
+            self._watch(name)
+            if ingest and (full or name in dirty or name in changes["added"]):
+                count = await self._scan_gallery(name)
+                if count:
+                    added[name] = count
+        for name, count in added.items():
+            logger.info(f"[KCBXT] 图库【{name}】登记了{count}张手动放入的图片")
+        return added
+
+    async def run(self):
+        """热加载循环：收到目录事件或每隔 interval 秒检查一次"""
+        self._start_inotify()
+        try:
+            await self.check(full=True)
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                try:
+                    await self.check()
+                except Exception as e:
+                    logger.error(f"[KCBXT] 图库热加载失败: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        """停止监听目录事件"""
+        if self._inotify is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify.fileno())
+            self._inotify.close()
+            self._inotify = None
\ No newline at end of file